@@ -1,11 +1,46 @@
 import streamlit as st
 import openai
 from datetime import datetime, timedelta
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import pandas as pd
 import altair as alt
 import json
+import uuid
+
+import tracing
+
+from search_console import (
+    EXPORT_FORMATS,
+    SEARCH_CONSOLE_DIMENSIONS,
+    TABLE_PAGE_SIZE,
+    TREND_WINDOW_DAYS,
+    aggregate_daily,
+    chart_frame,
+    compute_trends,
+    dimension_columns,
+    fetch_multiple_sites,
+    fetch_search_console,
+    get_client,
+    get_result_store,
+    serialize_dataframe,
+    table_page,
+)
+from llm_agent import (
+    CONTEXT_TOKEN_BUDGET,
+    build_analysis_prompt,
+    build_data_summary,
+    cached_analysis_stream,
+    detect_sort_intent,
+    get_llm_cache,
+    plan_question,
+    run_plan,
+    token_encoding,
+)
+from llm_client import (
+    LLM_ANALYSIS_MODEL,
+    LLM_BASE_URL,
+    LLM_PLANNING_MODEL,
+    get_llm_client,
+)
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(page_title="Agente Analítico", layout="wide")
@@ -29,6 +64,23 @@ with st.sidebar:
         st.success("✅ Clave de OpenAI configurada")
     else:
         st.warning("⚠️ Falta la clave de OpenAI")
+
+    with st.expander("Modelos y servidor"):
+        planning_model = st.text_input(
+            "Modelo de planificación",
+            value=LLM_PLANNING_MODEL,
+            help="Elige la función y sus argumentos: conviene un modelo rápido y barato"
+        )
+        analysis_model = st.text_input(
+            "Modelo de análisis",
+            value=LLM_ANALYSIS_MODEL,
+            help="Redacta el análisis final a partir de los datos"
+        )
+        llm_base_url = st.text_input(
+            "Base URL (opcional)",
+            value=LLM_BASE_URL or "",
+            help="Servidor compatible con OpenAI, por ejemplo un mock local para pruebas"
+        )
     
     st.divider()
     
@@ -57,16 +109,39 @@ with st.sidebar:
         client_email = st.text_input("Client Email", placeholder="...@....iam.gserviceaccount.com")
         client_id = st.text_input("Client ID")
 
+    st.divider()
+
+    # Opciones de obtención de datos
+    st.subheader("⚙️ Datos")
+    incremental_sync = st.checkbox(
+        "📅 Sincronización incremental por día",
+        value=False,
+        help="Guarda los datos de cada día en local y solo descarga las fechas que faltan o que aún pueden cambiar"
+    )
+    context_token_budget = st.slider(
+        "🧮 Tokens de datos para el análisis de IA",
+        min_value=500,
+        max_value=8000,
+        value=CONTEXT_TOKEN_BUDGET,
+        step=250,
+        help="Más tokens dan más filas de muestra al modelo, a cambio de más coste y latencia"
+    )
+    if token_encoding(analysis_model) is None:
+        st.caption("⚠️ Sin tokenizador para este modelo (tiktoken): el presupuesto se estima a ~4 caracteres por token")
+    show_performance_panel = st.checkbox(
+        "⏱️ Mostrar panel de rendimiento",
+        value=False,
+        help="Tiempo, filas, bytes, cuota y tokens de cada etapa de la última petición, y p50/p95 recientes"
+    )
+
 # --- VALIDAR CREDENCIALES DE GOOGLE ---
-google_creds = None
+# El cliente se conserva entre reruns: el token OAuth y el servicio no se reconstruyen en cada interacción
+search_client = None
 
 if json_credentials.strip():
     try:
         service_account_info = json.loads(json_credentials)
-        google_creds = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=["https://www.googleapis.com/auth/webmasters.readonly"]
-        )
+        search_client = get_client(service_account_info)
         st.sidebar.success("✅ Credenciales de Google (JSON) configuradas")
     except json.JSONDecodeError:
         st.sidebar.error("❌ JSON inválido")
@@ -87,22 +162,23 @@ elif all([project_id, private_key_id, private_key, client_email, client_id]):
             "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
             "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{client_email}"
         }
-        google_creds = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=["https://www.googleapis.com/auth/webmasters.readonly"]
-        )
+        search_client = get_client(service_account_info)
         st.sidebar.success("✅ Credenciales de Google (manual) configuradas")
     except Exception as e:
         st.sidebar.error(f"❌ Error en credenciales: {str(e)}")
 else:
     st.sidebar.warning("⚠️ Faltan credenciales de Google")
 
+# La lista de propiedades se pide en segundo plano mientras se dibuja el resto de la página
+if search_client:
+    search_client.prefetch_sites()
+
 # --- VERIFICAR QUE TODO ESTÉ CONFIGURADO ---
 if not openai_key:
     st.error("❌ Por favor, configura tu clave de OpenAI en la barra lateral")
     st.stop()
 
-if not google_creds:
+if not search_client:
     st.error("❌ Por favor, configura tus credenciales de Google Service Account en la barra lateral")
     st.info(""", unsafe_allow_html=True)"
     ### 📝 Cómo obtener las credenciales de Google:
@@ -117,61 +193,25 @@ if not google_creds:
     st.stop()
 
 # --- FUNCIONES DE GOOGLE SEARCH CONSOLE ---
-def get_search_console_ctr(site_url, start_date, end_date, query_filter=None):
+def get_search_console_ctr(site_url, start_date, end_date, query_filter=None, max_rows=None, dimensions=None):
     try:
-        service = build('searchconsole', 'v1', credentials=google_creds)
-        request = {
-            'startDate': start_date,
-            'endDate': end_date,
-            'dimensions': ['query'],
-            'rowLimit': 1000,
-        }
-        if query_filter:
-            request['dimensionFilterGroups'] = [{
-                'filters': [{
-                    'dimension': 'query',
-                    'operator': 'contains',
-                    'expression': query_filter
-                }]
-            }]
-        
-        response = service.searchanalytics().query(siteUrl=site_url, body=request).execute()
-        rows = response.get('rows', [])
-        
-        if not rows:
-            return pd.DataFrame()
-        
-        # Procesar los datos
-        data = []
-        for row in rows:
-            keys = row.get('keys', [])
-            if not keys:
-                continue
-                
-            data.append({
-                'query': keys[0],
-                'clicks': row.get('clicks', 0),
-                'impressions': row.get('impressions', 0),
-                'ctr': round(row.get('ctr', 0) * 100, 2),
-                'position': round(row.get('position', 0), 1)
-            })
-        
-        df = pd.DataFrame(data)
-        df = df[df['query'].str.len() > 0]
-        df = df.sort_values('clicks', ascending=False).reset_index(drop=True)
-        return df
-        
+        return fetch_search_console(
+            search_client, site_url, start_date, end_date, query_filter, max_rows,
+            dimensions=dimensions, incremental=incremental_sync
+        )
     except Exception as e:
         st.error(f"Error al consultar Search Console: {str(e)}")
         return pd.DataFrame()
 
+def get_multi_site_ctr(site_urls, start_date, end_date, query_filter=None, max_rows=None, dimensions=None):
+    return fetch_multiple_sites(
+        search_client, site_urls, start_date, end_date, query_filter, max_rows,
+        dimensions=dimensions, incremental=incremental_sync
+    )
+
 def get_user_sites():
     try:
-        service = build('searchconsole', 'v1', credentials=google_creds)
-        response = service.sites().list().execute()
-        sites = response.get('siteEntry', [])
-        verified_sites = [site['siteUrl'] for site in sites if site.get('permissionLevel') in ['siteOwner', 'siteFullUser']]
-        return verified_sites
+        return search_client.list_sites()
     except Exception as e:
         if "403" in str(e):
             st.error("❌ Error 403: Sin permisos para acceder a Search Console")
@@ -183,41 +223,106 @@ def get_user_sites():
             st.error(f"Error al obtener propiedades: {str(e)}")
         return []
 
-# --- DEFINICIÓN DE FUNCIONES PARA LLM ---
-functions = [
-    {
-        "name": "get_search_console_ctr",
-        "description": "Obtiene datos de CTR, clics, impresiones y posición de una propiedad en Search Console",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "site_url": {
-                    "type": "string",
-                    "description": "URL de la propiedad en Search Console"
-                },
-                "start_date": {
-                    "type": "string",
-                    "description": "Fecha de inicio en formato YYYY-MM-DD"
-                },
-                "end_date": {
-                    "type": "string",
-                    "description": "Fecha de fin en formato YYYY-MM-DD"
-                },
-                "query_filter": {
-                    "type": "string",
-                    "description": "Filtro opcional para las consultas de búsqueda (busca consultas que contengan este texto)"
-                }
-            },
-            "required": ["site_url", "start_date", "end_date"]
-        }
+# --- DATOS CARGADOS EN LA SESIÓN ---
+def get_loaded_result(site_url, start_date, end_date, dimensions):
+    # Solo se reutilizan los datos cargados para la misma propiedad, el mismo rango y las mismas dimensiones
+    loaded = st.session_state.get('loaded_result')
+    if loaded and (loaded['site_url'], loaded['start_date'], loaded['end_date']) == (site_url, start_date, end_date) \
+            and set(loaded['dimensions']) == set(dimensions):
+        return loaded
+    return None
+
+def set_loaded_result(df, site_url, start_date, end_date, query_filter=None, dimensions=None):
+    st.session_state['loaded_result'] = {
+        'df': df,
+        'site_url': site_url,
+        'start_date': start_date,
+        'end_date': end_date,
+        'query_filter': query_filter,
+        'dimensions': list(dimensions or dimension_columns(df))
     }
-]
+
+# --- VISUALIZACIÓN ---
+# El formato numérico lo aplica el navegador: la tabla conserva los tipos en lugar de convertirlos a texto
+TABLE_COLUMN_CONFIG = {
+    'clicks': st.column_config.NumberColumn("clicks", format="localized"),
+    'impressions': st.column_config.NumberColumn("impressions", format="localized"),
+    'ctr': st.column_config.NumberColumn("ctr", format="%.2f%%"),
+    'position': st.column_config.NumberColumn("position", format="%.1f"),
+}
+
+@st.fragment
+def render_table(df, name="tabla"):
+    # Solo se envía la página visible; cambiar de página vuelve a ejecutar este fragmento, no la consulta
+    pages = max(1, -(-len(df) // TABLE_PAGE_SIZE))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Página (de {pages}):", min_value=1, max_value=pages, value=1, key=f"{name}_page_{pages}")
+    st.dataframe(table_page(df, page), column_config=TABLE_COLUMN_CONFIG, width='stretch')
+
+def render_trends(trend_summary, trend_daily):
+    if trend_summary.empty:
+        st.warning("⚠️ El modo tendencia necesita datos con la dimensión 'date'")
+        return
+    st.subheader("📉 Tendencia y anomalías")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("🔎 Series analizadas", len(trend_summary))
+    with col2:
+        st.metric("⚠️ Series con anomalías", int((trend_summary['anomalies'] > 0).sum()))
+    with col3:
+        st.metric(
+            "👆 Clics 2ª mitad vs 1ª",
+            f"{int(trend_summary['clicks_current'].sum()):,}",
+            delta=f"{int(trend_summary['clicks_delta'].sum()):,}"
+        )
+
+    # CTR móvil por serie y, encima, los días marcados como anómalos
+    base = alt.Chart(trend_daily).encode(x=alt.X('date:T', title='Fecha'))
+    lines = base.mark_line().encode(
+        y=alt.Y('ctr_rolling:Q', title=f'CTR móvil {TREND_WINDOW_DAYS} días (%)'),
+        color=alt.Color('label:N', title='Serie'),
+        tooltip=['label', 'date:T', 'ctr', 'ctr_rolling', 'clicks', 'impressions']
+    )
+    points = base.transform_filter(alt.datum.anomaly).mark_point(filled=True, size=80, color='red').encode(
+        y='ctr:Q',
+        tooltip=['label', 'date:T', 'ctr', 'z', 'impressions']
+    )
+    st.altair_chart((lines + points).properties(title="CTR por día con anomalías marcadas", height=400), width='stretch')
+    render_table(trend_summary, name="tendencias")
+
+def metric_chart(chart_df, label_type, label_title, metric, sort_order):
+    # Una línea solo une puntos con orden (fechas); entre consultas o páginas sugeriría una tendencia
+    # que no existe, así que se dibujan puntos ordenados por la métrica
+    chart = alt.Chart(chart_df)
+    if label_type == 'T':
+        return chart.mark_line(point=True).encode(
+            x=alt.X('label:T', title=label_title, axis=alt.Axis(labelAngle=-45))
+        )
+    return chart.mark_point(filled=True, size=80).encode(
+        x=alt.X('label:N', title=label_title, sort=alt.EncodingSortField(field=metric, order=sort_order), axis=alt.Axis(labelAngle=-45))
+    )
+
+@st.fragment
+def render_download(df):
+    # El archivo solo se genera cuando se pulsa; cambiar el formato no repite la consulta
+    col_fmt, col_dl = st.columns([1, 2])
+    with col_fmt:
+        export_format = st.selectbox("Formato:", list(EXPORT_FORMATS), key="export_format")
+    extension, mime = EXPORT_FORMATS[export_format]
+    with col_dl:
+        st.download_button(
+            label=f"📥 Descargar datos completos ({export_format})",
+            data=lambda: serialize_dataframe(df, export_format),
+            file_name=f"search_console_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}",
+            mime=mime
+        )
 
 # --- INTERFAZ PRINCIPAL ---
 st.header("🔍 Análisis de Search Console")
 
 # Validar que las credenciales estén configuradas antes de continuar
-if not google_creds:
+if not search_client:
     st.warning("⚠️ Configura primero las credenciales de Google en la barra lateral")
     st.stop()
 
@@ -226,19 +331,27 @@ with st.spinner("🔄 Cargando propiedades de Search Console..."):
     user_sites = get_user_sites()
 
 col1, col2 = st.columns([2, 1])
+multi_site_mode = False
+selected_sites = []
 
 with col1:
     if user_sites:
         site_url = st.selectbox("Selecciona una propiedad:", user_sites)
         st.success(f"✅ {len(user_sites)} propiedades disponibles")
+        multi_site_mode = st.checkbox(
+            "🗂️ Comparar varias propiedades",
+            help="La consulta directa se ejecuta en paralelo sobre todas las propiedades seleccionadas"
+        )
+        if multi_site_mode:
+            selected_sites = st.multiselect("Propiedades a consultar:", user_sites, default=[site_url])
     else:
         st.warning("⚠️ No se encontraron propiedades o hay un error de configuración")
         site_url = st.text_input("URL manual de la propiedad:", placeholder="https://example.com/")
         st.info("Asegúrate de que el Service Account tenga acceso a la propiedad en Search Console")
 
 with col2:
-    if st.button("🔄 Actualizar propiedades"):
-        st.rerun()
+    # El callback invalida la caché antes del rerun, así que la lista se vuelve a pedir solo aquí
+    st.button("🔄 Actualizar propiedades", on_click=search_client.invalidate_sites)
 
 # --- CONFIGURACIÓN DE FECHAS ---
 col3, col4, col5 = st.columns([1, 1, 1])
@@ -295,12 +408,25 @@ query = st.text_area(
     height=80
 )
 
+# Si la pregunta cambia, se cancelan las peticiones al modelo que sigan en curso para la anterior
+llm_client = get_llm_client(openai_key, llm_base_url)
+llm_group = st.session_state.setdefault('llm_group', uuid.uuid4().hex)
+if st.session_state.get('llm_question') not in (None, query):
+    llm_client.cancel(llm_group)
+
 # --- SELECCIÓN DE VISUALIZACIÓN ---
-col6, col7 = st.columns(2)
+col6, col7, col8 = st.columns(3)
 with col6:
-    tipo_grafico = st.selectbox("Visualización:", ["Tabla", "Gráfico de barras", "Línea - Posición", "Línea - CTR"])
+    tipo_grafico = st.selectbox("Visualización:", ["Tabla", "Gráfico de barras", "Línea - Posición", "Línea - CTR", "Tendencia y anomalías"])
 with col7:
-    max_results = st.slider("Máximo resultados:", 10, 100, 20)
+    max_results = st.slider("Máximo resultados:", 10, 1000, 20)
+with col8:
+    selected_dimensions = st.multiselect("Dimensiones:", SEARCH_CONSOLE_DIMENSIONS, default=['query']) or ['query']
+
+# El modo tendencia necesita una fila por clave y día
+trend_mode = tipo_grafico == "Tendencia y anomalías"
+if trend_mode and 'date' not in selected_dimensions:
+    selected_dimensions = selected_dimensions + ['date']
 
 # --- BOTONES DE ACCIÓN ---
 col_btn1, col_btn2, col_btn3 = st.columns([1, 1, 2])
@@ -319,198 +445,237 @@ with col_btn3:
 # --- PROCESO PRINCIPAL ---
 if (analyze_button or direct_query) and query and query.strip() and site_url:
     
-    # Consulta directa sin IA
-    if direct_query:
-        with st.spinner("📊 Obteniendo datos directamente..."):
-            df_result = get_search_console_ctr(
-                site_url=site_url,
-                start_date=start_date,
-                end_date=end_date,
-                query_filter=None
-            )
-            
-            if df_result.empty:
-                st.warning("⚠️ No se encontraron datos para los criterios especificados")
-            else:
-                st.success(f"✅ Datos obtenidos: {len(df_result)} consultas")
-                
-                # Mostrar métricas
-                col1, col2, col3, col4 = st.columns(4)
-                with col1:
-                    st.metric("📊 Total Consultas", len(df_result))
-                with col2:
-                    st.metric("👆 Total Clics", f"{int(df_result['clicks'].sum()):,}")
-                with col3:
-                    st.metric("👀 Total Impresiones", f"{int(df_result['impressions'].sum()):,}")
-                with col4:
-                    avg_ctr = df_result['ctr'].mean()
-                    st.metric("📈 CTR Promedio", f"{avg_ctr:.2f}%")
-                
-                # Análisis simple basado en la consulta
-                if "mayor CTR" in query.lower() or "mejor CTR" in query.lower():
-                    top_ctr = df_result.nlargest(10, 'ctr')
-                    st.subheader("🏆 Top 10 consultas con mayor CTR:")
-                    st.dataframe(top_ctr[['query', 'ctr', 'clicks', 'position']], use_container_width=True)
-                
-                elif "más clics" in query.lower() or "mayor tráfico" in query.lower():
-                    top_clicks = df_result.nlargest(10, 'clicks')
-                    st.subheader("🚀 Top 10 consultas con más clics:")
-                    st.dataframe(top_clicks[['query', 'clicks', 'ctr', 'position']], use_container_width=True)
-                
-                elif "mejor posición" in query.lower() or "posición" in query.lower():
-                    top_position = df_result.nsmallest(10, 'position')
-                    st.subheader("📈 Top 10 consultas con mejor posición:")
-                    st.dataframe(top_position[['query', 'position', 'clicks', 'ctr']], use_container_width=True)
-                
+    with tracing.trace("analisis_ia" if analyze_button else "consulta_directa", question=query, site_url=site_url) as request_trace:
+        st.session_state['last_trace_id'] = request_trace.trace_id
+        # Consulta directa sin IA
+        if direct_query:
+            with st.spinner("📊 Obteniendo datos directamente..."):
+                if multi_site_mode and selected_sites:
+                    df_result, site_errors = get_multi_site_ctr(selected_sites, start_date, end_date, dimensions=selected_dimensions)
+                    for error_site, error in site_errors.items():
+                        st.error(f"Error al consultar {error_site}: {error}")
                 else:
-                    df_display = df_result.head(max_results)
-                    st.subheader("📈 Resultados generales:")
-                    st.dataframe(df_display, use_container_width=True)
-    
-    # Análisis con IA
-    elif analyze_button:
-        with st.spinner("🤖 Analizando con IA..."):
-            try:
-                from openai import OpenAI
-                client = OpenAI(api_key=openai_key)
-                
-                enhanced_prompt = f"""
-                Tengo una propiedad de Search Console en: {site_url}
-                Quiero analizar datos del {start_date} al {end_date}
-                
-                Pregunta del usuario: {query}
-                
-                Para responder a esta pregunta, necesitas usar la función get_search_console_ctr con los parámetros apropiados.
-                Si la pregunta menciona filtros específicos (como palabras clave), úsalos en query_filter.
-                """
+                    df_result = get_search_console_ctr(
+                        site_url=site_url,
+                        start_date=start_date,
+                        end_date=end_date,
+                        query_filter=None,
+                        dimensions=selected_dimensions
+                    )
                 
-                response = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "Eres un analista de datos especializado en Search Console. Siempre debes usar las funciones disponibles para obtener datos reales antes de responder preguntas sobre métricas de búsqueda."},
-                        {"role": "user", "content": enhanced_prompt}
-                    ],
-                    tools=[{"type": "function", "function": func} for func in functions],
-                    tool_choice={"type": "function", "function": {"name": "get_search_console_ctr"}}
-                )
-
-                if response.choices[0].message.tool_calls:
-                    function_call = response.choices[0].message.tool_calls[0].function
+                if df_result.empty:
+                    st.warning("⚠️ No se encontraron datos para los criterios especificados")
+                else:
+                    if 'site_url' not in df_result.columns:
+                        set_loaded_result(df_result, site_url, start_date, end_date, dimensions=selected_dimensions)
+                    st.success(f"✅ Datos obtenidos: {len(df_result)} consultas")
+                    key_cols = dimension_columns(df_result)
+                    site_cols = ['site_url'] if 'site_url' in key_cols else []
                     
-                    try:
-                        args = json.loads(function_call.arguments)
-                        
-                        with st.spinner("📊 Obteniendo datos de Search Console..."):
-                            df_result = get_search_console_ctr(
-                                site_url=args.get("site_url", site_url),
-                                start_date=args.get("start_date", start_date),
-                                end_date=args.get("end_date", end_date),
-                                query_filter=args.get("query_filter")
-                            )
-
-                        if df_result.empty:
-                            st.warning("⚠️ No se encontraron datos para los criterios especificados")
-                        else:
-                            st.success(f"✅ Se encontraron {len(df_result)} consultas")
-                            
-                            df_display = df_result.head(max_results)
-                            
-                            # Mostrar métricas
-                            col1, col2, col3, col4 = st.columns(4)
-                            with col1:
-                                st.metric("📊 Total Consultas", len(df_result))
-                            with col2:
-                                st.metric("👆 Total Clics", f"{int(df_result['clicks'].sum()):,}")
-                            with col3:
-                                st.metric("👀 Total Impresiones", f"{int(df_result['impressions'].sum()):,}")
-                            with col4:
-                                avg_ctr = df_result['ctr'].mean()
-                                st.metric("📈 CTR Promedio", f"{avg_ctr:.2f}%")
-                            
-                            # Visualización
-                            st.subheader("📈 Resultados")
+                    # Mostrar métricas
+                    col1, col2, col3, col4 = st.columns(4)
+                    with col1:
+                        st.metric("📊 Total Consultas", len(df_result))
+                    with col2:
+                        st.metric("👆 Total Clics", f"{int(df_result['clicks'].sum()):,}")
+                    with col3:
+                        st.metric("👀 Total Impresiones", f"{int(df_result['impressions'].sum()):,}")
+                    with col4:
+                        avg_ctr = df_result['ctr'].mean()
+                        st.metric("📈 CTR Promedio", f"{avg_ctr:.2f}%")
+                    
+                    if site_cols:
+                        st.subheader("🗂️ Resumen por propiedad:")
+                        st.dataframe(aggregate_daily(df_result, site_cols), column_config=TABLE_COLUMN_CONFIG, width='stretch')
+                    
+                    # Análisis simple basado en la consulta
+                    sort_intent = detect_sort_intent(query)
+                    if sort_intent == ('ctr', False):
+                        top_ctr = df_result.nlargest(10, 'ctr')
+                        st.subheader("🏆 Top 10 consultas con mayor CTR:")
+                        st.dataframe(top_ctr[key_cols + ['ctr', 'clicks', 'position']], column_config=TABLE_COLUMN_CONFIG, width='stretch')
+                    
+                    elif sort_intent == ('clicks', False):
+                        top_clicks = df_result.nlargest(10, 'clicks')
+                        st.subheader("🚀 Top 10 consultas con más clics:")
+                        st.dataframe(top_clicks[key_cols + ['clicks', 'ctr', 'position']], column_config=TABLE_COLUMN_CONFIG, width='stretch')
+                    
+                    elif sort_intent == ('position', True):
+                        top_position = df_result.nsmallest(10, 'position')
+                        st.subheader("📈 Top 10 consultas con mejor posición:")
+                        st.dataframe(top_position[key_cols + ['position', 'clicks', 'ctr']], column_config=TABLE_COLUMN_CONFIG, width='stretch')
+                    
+                    else:
+                        df_display = df_result.head(max_results)
+                        st.subheader("📈 Resultados generales:")
+                        render_table(df_display)
+
+                    if trend_mode:
+                        with tracing.span("trends", rows=len(df_result)):
+                            trends = compute_trends(df_result, key_cols)
+                        render_trends(*trends)
+        
+        # Análisis con IA
+        elif analyze_button:
+            with st.spinner("🤖 Analizando con IA..."):
+                try:
+                    st.session_state['llm_question'] = query
+                    
+                    # Si ya hay datos cargados para este rango, el modelo puede analizarlos en local
+                    loaded_result = get_loaded_result(site_url, start_date, end_date, selected_dimensions)
+                    plan, plan_key = plan_question(
+                        llm_client, query, site_url, start_date, end_date, loaded_result,
+                        model=planning_model, group=llm_group, dimensions=selected_dimensions
+                    )
+                    if plan_key is None:
+                        st.caption("⚡ Pregunta interpretada localmente, sin llamada al modelo")
+
+                    if "name" in plan:
+                        try:
+                            args = json.loads(plan["arguments"])
+                            if plan_key is not None:
+                                get_llm_cache().put(plan_key, plan)
+                            if trend_mode and args.get("dimensions") and 'date' not in args["dimensions"]:
+                                args["dimensions"] = args["dimensions"] + ['date']
                             
-                            if tipo_grafico == "Tabla":
-                                df_formatted = df_display.copy()
-                                df_formatted['clicks'] = df_formatted['clicks'].apply(lambda x: f"{x:,}")
-                                df_formatted['impressions'] = df_formatted['impressions'].apply(lambda x: f"{x:,}")
-                                df_formatted['ctr'] = df_formatted['ctr'].apply(lambda x: f"{x}%")
-                                
-                                st.dataframe(df_formatted, use_container_width=True)
-                                
-                            elif tipo_grafico == "Gráfico de barras":
-                                chart = alt.Chart(df_display).mark_bar().encode(
-                                    x=alt.X('clicks:Q', title='Clics'),
-                                    y=alt.Y('query:N', title='Consulta', sort='-x'),
-                                    tooltip=['query', 'clicks', 'impressions', 'ctr', 'position']
-                                ).properties(title=f"Top {len(df_display)} Consultas por Clics", height=400)
-                                st.altair_chart(chart, use_container_width=True)
+                            with st.spinner("📊 Obteniendo datos..."):
+                                df_result, loaded = run_plan(
+                                    search_client, plan, args, site_url, start_date, end_date,
+                                    loaded_result=loaded_result,
+                                    default_dimensions=selected_dimensions,
+                                    incremental=incremental_sync
+                                )
+                            if loaded is not None:
+                                set_loaded_result(**loaded)
+
+                            if df_result.empty:
+                                st.warning("⚠️ No se encontraron datos para los criterios especificados")
+                            else:
+                                st.success(f"✅ Se encontraron {len(df_result)} consultas")
                                 
-                            elif tipo_grafico == "Línea - Posición":
-                                chart = alt.Chart(df_display).mark_line(point=True).encode(
-                                    x=alt.X('query:N', title='Consulta', axis=alt.Axis(labelAngle=-45)),
-                                    y=alt.Y('position:Q', title='Posición promedio', scale=alt.Scale(reverse=True)),
-                                    tooltip=['query', 'position', 'clicks', 'impressions']
-                                ).properties(title="Posición promedio por consulta (menor es mejor)", height=400)
-                                st.altair_chart(chart, use_container_width=True)
+                                df_display = df_result.head(max_results)
+                                key_cols = dimension_columns(df_result)
                                 
-                            elif tipo_grafico == "Línea - CTR":
-                                chart = alt.Chart(df_display).mark_line(point=True).encode(
-                                    x=alt.X('query:N', title='Consulta', axis=alt.Axis(labelAngle=-45)),
-                                    y=alt.Y('ctr:Q', title='CTR (%)'),
-                                    tooltip=['query', 'ctr', 'clicks', 'impressions']
-                                ).properties(title="CTR por consulta", height=400)
-                                st.altair_chart(chart, use_container_width=True)
-                            
-                            # Análisis de IA
-                            if not df_result.empty:
-                                analysis_prompt = f"""
-                                Basándote en estos datos de Search Console, responde a la pregunta: "{query}"
+                                # Las tendencias se calculan sobre todos los datos cargados, no solo sobre el resultado filtrado
+                                trend_summary = trend_daily = None
+                                if trend_mode:
+                                    trend_source = (loaded or loaded_result or {'df': df_result})['df']
+                                    with tracing.span("trends", rows=len(trend_source)):
+                                        trend_summary, trend_daily = compute_trends(trend_source, dimension_columns(trend_source))
+                                with tracing.span("llm.context"):
+                                    data_summary = build_data_summary(df_result, query, trend_summary, context_token_budget, analysis_model)
+                                analysis_prompt = build_analysis_prompt(query, data_summary)
+                                # Se lanza antes de dibujar métricas y gráficos para solapar ambos trabajos
+                                analysis_stream = cached_analysis_stream(
+                                    llm_client, query, data_summary, analysis_prompt,
+                                    model=analysis_model, group=llm_group
+                                )
                                 
-                                Datos obtenidos:
-                                - Total de consultas analizadas: {len(df_result)}
-                                - CTR promedio: {df_result['ctr'].mean():.2f}%
-                                - Total de clics: {df_result['clicks'].sum()}
-                                - Posición promedio: {df_result['position'].mean():.1f}
+                                # Gráficos con pocos puntos: agregados por fecha o limitados a las primeras filas
+                                chart_df, label_type = chart_frame(df_result, key_cols, max_results)
+                                label_title = 'Fecha' if label_type == 'T' else 'Consulta'
                                 
-                                Top 5 consultas por CTR:
-                                {df_result.nlargest(5, 'ctr')[['query', 'ctr', 'clicks', 'position']].to_string()}
+                                # Mostrar métricas
+                                col1, col2, col3, col4 = st.columns(4)
+                                with col1:
+                                    st.metric("📊 Total Consultas", len(df_result))
+                                with col2:
+                                    st.metric("👆 Total Clics", f"{int(df_result['clicks'].sum()):,}")
+                                with col3:
+                                    st.metric("👀 Total Impresiones", f"{int(df_result['impressions'].sum()):,}")
+                                with col4:
+                                    avg_ctr = df_result['ctr'].mean()
+                                    st.metric("📈 CTR Promedio", f"{avg_ctr:.2f}%")
                                 
-                                Proporciona un análisis conciso y accionable.
-                                """
+                                # Visualización
+                                st.subheader("📈 Resultados")
                                 
-                                analysis_response = client.chat.completions.create(
-                                    model="gpt-4",
-                                    messages=[{"role": "user", "content": analysis_prompt}]
-                                )
+                                with tracing.span("render", view=tipo_grafico, points=len(chart_df)):
+                                    if tipo_grafico == "Tabla":
+                                        render_table(df_display)
+                                    
+                                    elif tipo_grafico == "Gráfico de barras":
+                                        chart = alt.Chart(chart_df).mark_bar().encode(
+                                            x=alt.X('clicks:Q', title='Clics'),
+                                            y=alt.Y(f'label:{label_type}', title=label_title, sort='-x' if label_type == 'N' else None),
+                                            tooltip=['label', 'clicks', 'impressions', 'ctr', 'position']
+                                        ).properties(title=f"Top {len(chart_df)} por Clics", height=400)
+                                        st.altair_chart(chart, width='stretch')
+                                    
+                                    elif tipo_grafico == "Línea - Posición":
+                                        chart = metric_chart(chart_df, label_type, label_title, 'position', 'ascending').encode(
+                                            y=alt.Y('position:Q', title='Posición promedio', scale=alt.Scale(reverse=True)),
+                                            tooltip=['label', 'position', 'clicks', 'impressions']
+                                        ).properties(title=f"Posición promedio por {label_title.lower()} (menor es mejor)", height=400)
+                                        st.altair_chart(chart, width='stretch')
+                                    
+                                    elif tipo_grafico == "Línea - CTR":
+                                        chart = metric_chart(chart_df, label_type, label_title, 'ctr', 'descending').encode(
+                                            y=alt.Y('ctr:Q', title='CTR (%)'),
+                                            tooltip=['label', 'ctr', 'clicks', 'impressions']
+                                        ).properties(title=f"CTR por {label_title.lower()}", height=400)
+                                        st.altair_chart(chart, width='stretch')
+
+                                    elif trend_mode:
+                                        render_trends(trend_summary, trend_daily)
                                 
+                                # Análisis de IA: el texto ya se está generando desde antes de los gráficos
                                 st.info("🤖 Análisis de IA:")
-                                st.write(analysis_response.choices[0].message.content)
-                            
-                            # Botón de descarga
-                            csv = df_result.to_csv(index=False)
-                            st.download_button(
-                                label="📥 Descargar datos completos (CSV)",
-                                data=csv,
-                                file_name=f"search_console_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                                mime="text/csv"
-                            )
-
-                    except json.JSONDecodeError:
-                        st.error("❌ Error al procesar los argumentos de la función")
-                    except Exception as e:
-                        st.error(f"❌ Error al ejecutar la consulta: {str(e)}")
-                else:
-                    st.info("💭 Respuesta del modelo:")
-                    st.write(response.choices[0].message.content)
-                    
-            except Exception as e:
-                st.error(f"❌ Error al consultar el modelo de IA: {str(e)}")
-                st.info("Verifica que tu clave de OpenAI sea válida y tenga créditos disponibles")
+                                try:
+                                    with tracing.span("llm.analysis", model=analysis_model):
+                                        st.write_stream(analysis_stream)
+                                except Exception as e:
+                                    st.error(f"❌ Error al generar el análisis de IA: {str(e)}")
+                                
+                                # Botón de descarga
+                                render_download(df_result)
+
+                        except json.JSONDecodeError:
+                            st.error("❌ Error al procesar los argumentos de la función")
+                        except Exception as e:
+                            st.error(f"❌ Error al ejecutar la consulta: {str(e)}")
+                    else:
+                        st.info("💭 Respuesta del modelo:")
+                        st.write(plan["content"])
+                        
+                except Exception as e:
+                    st.error(f"❌ Error al consultar el modelo de IA: {str(e)}")
+                    st.info("Verifica que tu clave de OpenAI sea válida y tenga créditos disponibles")
 
 elif query and query.strip() and not site_url:
     st.warning("⚠️ Por favor, selecciona o ingresa una URL de propiedad")
 
+# --- PANEL DE RENDIMIENTO ---
+if show_performance_panel:
+    with st.sidebar:
+        st.divider()
+        st.subheader("⏱️ Rendimiento")
+        traces = tracing.recent_traces()
+        last_trace = next(
+            (records for records in reversed(traces) if records[0]['trace_id'] == st.session_state.get('last_trace_id')),
+            None
+        )
+        if last_trace:
+            st.caption(f"Última petición: {last_trace[0]['name']} · {last_trace[0]['duration_ms']:,.0f} ms")
+            st.dataframe(tracing.spans_frame(last_trace), hide_index=True, width='stretch')
+        if traces:
+            st.caption(f"p50/p95 por etapa en las últimas {len(traces)} peticiones")
+            st.dataframe(tracing.stage_percentiles(), hide_index=True, width='stretch')
+            st.download_button(
+                label="📥 Exportar trazas (JSONL)",
+                data=lambda: tracing.traces_to_jsonl(tracing.recent_traces()),
+                file_name=f"trazas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl",
+                mime="application/x-ndjson"
+            )
+        else:
+            st.caption("Aún no hay peticiones medidas")
+        # El almacén es común a todas las sesiones del proceso
+        store = get_result_store().usage()
+        st.caption(
+            f"Resultados compartidos: {store['entries']} en memoria ({store['bytes'] / 2 ** 20:,.1f} MB) · "
+            f"{store['hits']} reutilizados · {store['coalesced']} unidos a una consulta en curso · {store['misses']} consultados"
+        )
+
 # --- FOOTER CON INFORMACIÓN ---
 st.divider()
 st.markdown("""
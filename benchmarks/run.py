@@ -0,0 +1,180 @@
+# Benchmark del pipeline completo sin red ni credenciales: Search Console se sirve desde un HttpMock
+# y el LLM desde un endpoint de chat local. Informa tiempo por etapa, filas/s y memoria máxima.
+# Cada tamaño se ejecuta en un proceso nuevo con su propia caché en un directorio temporal que se borra al acabar.
+#
+# Ejemplos:
+#   python -m benchmarks.run
+#   python -m benchmarks.run --sizes 1000 100000 --json resultados.json
+#   python -m benchmarks.run --baseline benchmarks/baseline.json --max-regression 0.25   # sale con 1 si empeora
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# La caché del LLM se queda en memoria; la de Search Console se redirige al directorio temporal en measure()
+os.environ['LLM_CACHE_PERSIST'] = '0'
+
+import search_console
+import tracing
+from benchmarks.stubs import FakeChatServer, SearchConsoleHttpMock
+from llm_agent import build_analysis_prompt, build_data_summary, plan_question, run_plan, start_analysis_stream
+from llm_client import LLMClient
+from search_console import (
+    SEARCH_CONSOLE_DIMENSIONS,
+    SearchConsoleClient,
+    TokenBucket,
+    chart_frame,
+    compute_trends,
+    fetch_search_console,
+    run_local_analysis,
+    serialize_dataframe,
+)
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+START_DATE, END_DATE = '2026-01-01', '2026-03-31'
+# Contiene un filtro ambiguo, así que la planificación pasa por el modelo y no por el intérprete local
+QUESTION = "¿Qué consultas relacionadas con zapatos tienen mejor CTR?"
+# Etapas por debajo de este tiempo son ruido y no cuentan como regresión
+MIN_COMPARABLE_SECONDS = 0.05
+
+def run_pipeline(http, size, dimensions, chat_url):
+    # Un recorrido completo como el de la aplicación; devuelve los registros de la traza
+    site_url = http.sites[0]
+    search_client = SearchConsoleClient(None, limiter=TokenBucket(1e9, 1e9), http=http)
+    llm_client = LLMClient('sk-benchmark', base_url=chat_url)
+
+    with tracing.trace('benchmark', rows=size):
+        with tracing.span('gsc.sites'):
+            search_client.list_sites(refresh=True)
+        plan, _ = plan_question(llm_client, QUESTION, site_url, START_DATE, END_DATE)
+        args = json.loads(plan['arguments'])
+        df_result, loaded = run_plan(search_client, plan, args, site_url, START_DATE, END_DATE, default_dimensions=dimensions)
+        # La misma consulta otra vez sale del almacén compartido en memoria
+        fetch_search_console(search_client, site_url, START_DATE, END_DATE, dimensions=dimensions)
+        with tracing.span('local.analysis'):
+            run_local_analysis(
+                loaded['df'],
+                filters=[{'column': 'impressions', 'operator': '>', 'value': 1000}],
+                sort_by='ctr',
+                top_k=100
+            )
+        trend_summary = None
+        if 'date' in dimensions:
+            with tracing.span('trends'):
+                trend_summary, _ = compute_trends(df_result, [d for d in dimensions if d != 'date'])
+        with tracing.span('render'):
+            chart_frame(df_result, dimensions)
+        with tracing.span('llm.context'):
+            data_summary = build_data_summary(df_result, QUESTION, trend_summary)
+        with tracing.span('llm.analysis'):
+            ''.join(start_analysis_stream(llm_client, build_analysis_prompt(QUESTION, data_summary)))
+        with tracing.span('export', format='parquet') as stage:
+            stage.set(bytes=len(serialize_dataframe(df_result, 'parquet')))
+    return tracing.recent_traces(1)[0]
+
+def summarize(records):
+    # Segundos por etapa; la consulta a la API y la lectura de caché se separan por el atributo cache
+    stages = {}
+    for record in records[1:]:
+        name = record['name']
+        if name == 'gsc.fetch':
+            name = f"gsc.fetch.{record['attributes'].get('cache', 'miss')}"
+        stages[name] = round(stages.get(name, 0) + record['duration_ms'] / 1000, 4)
+    return stages
+
+def max_rss_mb():
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+def measure(size, dimensions, chat_url, workdir):
+    # Se ejecuta en el proceso hijo. El pico de RSS incluye la memoria nativa de pandas y Arrow;
+    # se descuenta lo que ya ocupaban el intérprete y las respuestas simuladas antes de empezar
+    search_console.CACHE_DB_PATH = os.path.join(workdir, 'cache.sqlite')
+    http = SearchConsoleHttpMock(size, dimensions, sites=[f"https://bench-{size}.example.com/"]).prepare()
+    baseline = max_rss_mb()
+    records = run_pipeline(http, size, dimensions, chat_url)
+    total = records[0]['duration_ms'] / 1000
+    return {
+        'rows': size,
+        'total_seconds': round(total, 3),
+        'rows_per_second': round(size / total) if total else None,
+        'stages': summarize(records),
+        'peak_mb': round(max_rss_mb() - baseline, 1),
+        'baseline_mb': round(baseline, 1),
+    }
+
+def measure_in_subprocess(size, dimensions, chat_url, workdir):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(measure, size, dimensions, chat_url, workdir).result()
+
+def compare(results, baseline, max_regression):
+    # Devuelve las etapas (y totales) más lentas que la referencia por encima del margen permitido
+    regressions = []
+    reference = {entry['rows']: entry for entry in baseline['results']}
+    for result in results:
+        previous = reference.get(result['rows'])
+        if previous is None:
+            continue
+        pairs = [('total', result['total_seconds'], previous['total_seconds'])]
+        pairs += [(stage, seconds, previous['stages'].get(stage)) for stage, seconds in result['stages'].items()]
+        for stage, current, before in pairs:
+            if before is None or before < MIN_COMPARABLE_SECONDS:
+                continue
+            if current > before * (1 + max_regression):
+                regressions.append(f"{result['rows']} filas · {stage}: {before:.3f}s → {current:.3f}s")
+        if previous.get('peak_mb') and result['peak_mb'] > previous['peak_mb'] * (1 + max_regression):
+            regressions.append(f"{result['rows']} filas · memoria: {previous['peak_mb']} MB → {result['peak_mb']} MB")
+    return regressions
+
+def print_result(result):
+    print(
+        f"\n{result['rows']:,} filas: {result['total_seconds']:.2f}s · {result['rows_per_second']:,} filas/s · "
+        f"pico +{result['peak_mb']} MB (sobre {result['baseline_mb']} MB de partida)"
+    )
+    for stage, seconds in sorted(result['stages'].items(), key=lambda item: -item[1]):
+        print(f"  {stage:<22} {seconds:8.3f}s")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de Search Console y del LLM")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Filas devueltas por la API simulada")
+    parser.add_argument("--dimensions", nargs="+", choices=SEARCH_CONSOLE_DIMENSIONS, default=["query"])
+    parser.add_argument("--json", help="Guarda los resultados en este fichero")
+    parser.add_argument("--baseline", help="Resultados de referencia con los que comparar")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Empeoramiento relativo tolerado (0.25 = 25%%)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='gsc-bench-') as workdir, \
+            FakeChatServer(tool_arguments={'start_date': START_DATE, 'end_date': END_DATE}) as chat:
+        for size in args.sizes:
+            size_dir = os.path.join(workdir, str(size))
+            os.makedirs(size_dir)
+            results.append(measure_in_subprocess(size, args.dimensions, chat.base_url, size_dir))
+            print_result(results[-1])
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'dimensions': args.dimensions, 'results': results}
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print("\n❌ Regresiones respecto a la referencia:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            return 1
+        print("\n✅ Sin regresiones respecto a la referencia")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# Sustitutos locales de las APIs para los benchmarks: Search Console a través de HttpMock
+# y un servidor HTTP con un endpoint de chat compatible con OpenAI.
+import json
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+from googleapiclient.http import HttpMock
+
+import tracing
+from search_console import SEARCH_CONSOLE_PAGE_SIZE
+
+COUNTRIES = ['esp', 'mex', 'arg', 'col', 'chl', 'usa']
+DEVICES = ['MOBILE', 'DESKTOP', 'TABLET']
+
+# --- SEARCH CONSOLE ---
+def synthetic_rows(indices, dimensions, start_date='2026-01-01', days=90):
+    # Filas deterministas con la forma de searchanalytics().query. La fila i cae en el día i % days;
+    # con la dimensión fecha cada consulta se repite a lo largo de los días, como en los datos reales
+    first_day = date.fromisoformat(start_date)
+    per_key = days if 'date' in dimensions else 1
+    rows = []
+    for i in indices:
+        key = i // per_key
+        values = {
+            'query': f"consulta sintetica {key}",
+            'page': f"https://example.com/p/{key % 5000}",
+            'country': COUNTRIES[i % len(COUNTRIES)],
+            'device': DEVICES[i % len(DEVICES)],
+            'date': str(first_day + timedelta(days=i % days)),
+            'searchAppearance': 'WEB_LIGHT_RESULTS' if i % 7 == 0 else 'NONE',
+        }
+        clicks = i % 97
+        impressions = 100 + (i * 7) % 5000
+        rows.append({
+            'keys': [values[dimension] for dimension in dimensions],
+            'clicks': clicks,
+            'impressions': impressions,
+            'ctr': clicks / impressions,
+            'position': 1 + (i % 300) / 10,
+        })
+    return rows
+
+class SearchConsoleHttpMock(HttpMock):
+    # Responde a sites().list y a searchanalytics().query con filas construidas a partir de las dimensiones,
+    # las fechas y la página que pide cada consulta. total_rows son las filas de todo el período simulado;
+    # con la dimensión fecha un rango más corto (p. ej. un solo día de la sincronización incremental)
+    # devuelve solo las filas de esos días. prepare() serializa antes de medir las páginas de la consulta
+    # del benchmark, para que el coste del sustituto no cuente en los tiempos del pipeline
+    def __init__(self, total_rows, dimensions=('query',), sites=('https://example.com/',), start_date='2026-01-01', days=90):
+        super().__init__(headers={'status': '200'})
+        self.total_rows = total_rows
+        self.dimensions = list(dimensions)
+        self.sites = list(sites)
+        self.start_date = start_date
+        self.days = days
+        self.pages = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, page_size=SEARCH_CONSOLE_PAGE_SIZE):
+        first_day = date.fromisoformat(self.start_date)
+        query = {
+            'startDate': self.start_date,
+            'endDate': str(first_day + timedelta(days=self.days - 1)),
+            'dimensions': self.dimensions,
+            'rowLimit': page_size,
+        }
+        for start_row in range(0, self.total_rows, page_size):
+            query['startRow'] = start_row
+            self.pages[self._page_key(query)] = self._page(query)
+        return self
+
+    def _page_key(self, query):
+        return (
+            query['startDate'], query['endDate'], tuple(query['dimensions']),
+            query.get('startRow', 0), query.get('rowLimit', SEARCH_CONSOLE_PAGE_SIZE)
+        )
+
+    def _indices(self, query, start_row, row_limit):
+        # Posiciones de las filas de la página pedida entre las que caen en el rango de fechas
+        if 'date' not in query['dimensions']:
+            return range(start_row, min(start_row + row_limit, self.total_rows))
+        first_day = date.fromisoformat(self.start_date)
+        first = max(0, (date.fromisoformat(query['startDate']) - first_day).days)
+        last = min(self.days - 1, (date.fromisoformat(query['endDate']) - first_day).days)
+        if last < first:
+            return []
+        width = last - first + 1
+        count = sum(len(range(day, self.total_rows, self.days)) for day in range(first, last + 1))
+        return [j // width * self.days + first + j % width for j in range(start_row, min(start_row + row_limit, count))]
+
+    def _page(self, query):
+        indices = self._indices(query, query.get('startRow', 0), query.get('rowLimit', SEARCH_CONSOLE_PAGE_SIZE))
+        rows = synthetic_rows(indices, query['dimensions'], self.start_date, self.days)
+        return json.dumps({'rows': rows}).encode()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=1, connection_type=None):
+        with self._lock:
+            self.requests += 1
+        if 'searchAnalytics/query' in uri:
+            query = json.loads(body)
+            content = self.pages.get(self._page_key(query)) or self._page(query)
+        else:
+            content = json.dumps({
+                'siteEntry': [{'siteUrl': site, 'permissionLevel': 'siteOwner'} for site in self.sites]
+            }).encode()
+        # Igual que MeteredHttp, para que la traza incluya los bytes recibidos
+        tracing.add(bytes=len(content))
+        return httplib2.Response({'status': '200', 'content-type': 'application/json'}), content
+
+# --- ENDPOINT DE CHAT ---
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.requests += 1
+            failing = self.server.requests <= self.server.fail_first
+        time.sleep(self.server.latency)
+        if failing:
+            self._error(503)
+        elif request.get('stream'):
+            self._stream(request)
+        else:
+            self._complete(request)
+
+    def _complete(self, request):
+        if request.get('tools'):
+            function = request['tools'][0]['function']['name']
+            message = {'role': 'assistant', 'content': None, 'tool_calls': [{
+                'id': 'call_0', 'type': 'function',
+                'function': {'name': function, 'arguments': json.dumps(self.server.tool_arguments)}
+            }]}
+        else:
+            message = {'role': 'assistant', 'content': 'ok'}
+        body = json.dumps({
+            'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': len(json.dumps(request['messages'])) // 4, 'completion_tokens': 20, 'total_tokens': 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status):
+        body = json.dumps({'error': {'message': 'servicio no disponible', 'type': 'server_error'}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, request):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = [
+            {'choices': [{'index': 0, 'delta': {'content': f"fragmento {i} "}, 'finish_reason': None}]}
+            for i in range(self.server.stream_chunks)
+        ]
+        if request.get('stream_options', {}).get('include_usage'):
+            events.append({'choices': [], 'usage': {
+                'prompt_tokens': len(json.dumps(request['messages'])) // 4,
+                'completion_tokens': self.server.stream_chunks * 3,
+                'total_tokens': 0,
+            }})
+        for event in events:
+            event.update(id='chatcmpl-bench', object='chat.completion.chunk', created=0, model=request['model'])
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+class _ChatServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Un cliente que se rinde por timeout o cancelación cierra la conexión a mitad de respuesta
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeChatServer:
+    # Endpoint /v1/chat/completions local: llamadas con herramientas devuelven tool_arguments y
+    # las llamadas en streaming envían stream_chunks fragmentos; latency simula el tiempo del modelo
+    # y las primeras fail_first peticiones responden 503 para probar los reintentos
+    def __init__(self, tool_arguments=None, stream_chunks=50, latency=0.0, fail_first=0):
+        self.server = _ChatServer(('127.0.0.1', 0), _ChatHandler)
+        self.server.tool_arguments = tool_arguments or {}
+        self.server.stream_chunks = stream_chunks
+        self.server.latency = latency
+        self.server.fail_first = fail_first
+        self.server.requests = 0
+        self.server.lock = threading.Lock()
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
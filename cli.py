@@ -0,0 +1,102 @@
+# Exportación por lotes de Search Console a Parquet, sin interfaz de Streamlit.
+#
+# Ejemplos:
+#   python cli.py --credentials sa.json --all-sites --last-days 30 --output-dir exports
+#   python cli.py --credentials sa.json --site https://example.com/ --range 2024-01-01:2024-01-31 \
+#       --range 2024-02-01:2024-02-29 --dimensions query page --incremental
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from search_console import (
+    MAX_WORKERS,
+    SEARCH_CONSOLE_DIMENSIONS,
+    fetch_search_console,
+    get_client,
+)
+
+def parse_range(value):
+    start_date, _, end_date = value.partition(':')
+    for date in (start_date, end_date):
+        datetime.strptime(date, "%Y-%m-%d")
+    return start_date, end_date
+
+def site_slug(site_url):
+    return re.sub(r'[^A-Za-z0-9]+', '_', site_url).strip('_')
+
+def export_one(client, site_url, start_date, end_date, args):
+    df = fetch_search_console(
+        client, site_url, start_date, end_date,
+        query_filter=args.query_filter,
+        dimensions=args.dimensions,
+        incremental=args.incremental,
+        # Cada exportación se escribe una vez: guardarla en memoria solo retendría los DataFrames del lote
+        shared=False
+    )
+    path = os.path.join(args.output_dir, f"{site_slug(site_url)}_{start_date}_{end_date}.parquet")
+    df.assign(site_url=site_url).to_parquet(path, index=False, compression=args.compression)
+    return path, len(df)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Exporta datos de Search Console a Parquet")
+    parser.add_argument("--credentials", required=True, help="Ruta al JSON del Service Account")
+    parser.add_argument("--site", action="append", default=[], help="Propiedad a exportar (se puede repetir)")
+    parser.add_argument("--all-sites", action="store_true", help="Exporta todas las propiedades verificadas")
+    parser.add_argument("--range", action="append", type=parse_range, default=[], help="Rango YYYY-MM-DD:YYYY-MM-DD (se puede repetir)")
+    parser.add_argument("--last-days", type=int, help="Añade el rango de los últimos N días")
+    parser.add_argument("--dimensions", nargs="+", choices=SEARCH_CONSOLE_DIMENSIONS, default=["query"])
+    parser.add_argument("--query-filter", help="Solo consultas que contengan este texto")
+    parser.add_argument("--incremental", action="store_true", help="Usa la sincronización incremental por día")
+    parser.add_argument("--output-dir", default="exports")
+    parser.add_argument("--compression", default="zstd", help="Compresión de Parquet (zstd, snappy, gzip, none)")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.compression == "none":
+        args.compression = None
+
+    with open(args.credentials) as f:
+        client = get_client(json.load(f))
+
+    sites = list(args.site)
+    if args.all_sites:
+        sites += [site for site in client.list_sites() if site not in sites]
+    ranges = list(args.range)
+    if args.last_days:
+        end = datetime.today().date()
+        ranges.append((str(end - timedelta(days=args.last_days)), str(end)))
+    if not sites or not ranges:
+        print("❌ Indica al menos una propiedad (--site/--all-sites) y un rango (--range/--last-days)", file=sys.stderr)
+        return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    started = time.monotonic()
+    failures = 0
+    # Las peticiones comparten el limitador de cuota del proceso, así que el pool no la excede
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(export_one, client, site_url, start_date, end_date, args): (site_url, start_date, end_date)
+            for site_url in sites
+            for start_date, end_date in ranges
+        }
+        for future in as_completed(futures):
+            site_url, start_date, end_date = futures[future]
+            try:
+                path, rows = future.result()
+                print(f"✅ {site_url} {start_date}..{end_date}: {rows} filas -> {path}")
+            except Exception as e:
+                failures += 1
+                print(f"❌ {site_url} {start_date}..{end_date}: {e}", file=sys.stderr)
+
+    print(f"Exportados {len(futures) - failures}/{len(futures)} lotes en {time.monotonic() - started:.1f}s")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
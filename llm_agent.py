@@ -0,0 +1,587 @@
+# Orquestación del LLM: esquemas de funciones, planificación, intérprete local, caché y streaming.
+# No depende de Streamlit; el estado de la sesión (datos cargados) lo gestiona quien llama.
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import closing
+
+import pandas as pd
+
+import tracing
+
+# tiktoken está en requirements.txt; si falta o no conoce el modelo, el contexto se estima por caracteres
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+from llm_client import LLM_ANALYSIS_MODEL, LLM_PLANNING_MODEL
+from search_console import (
+    LOCAL_OPERATORS,
+    METRIC_COLUMNS,
+    SEARCH_CONSOLE_DIMENSIONS,
+    TREND_COLUMNS,
+    cache_connection,
+    dimension_columns,
+    fetch_search_console,
+    run_local_analysis,
+    series_label,
+)
+
+# --- DEFINICIÓN DE FUNCIONES PARA LLM ---
+functions = [
+    {
+        "name": "get_search_console_ctr",
+        "description": "Obtiene datos de CTR, clics, impresiones y posición de una propiedad en Search Console",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "site_url": {
+                    "type": "string",
+                    "description": "URL de la propiedad en Search Console"
+                },
+                "start_date": {
+                    "type": "string",
+                    "description": "Fecha de inicio en formato YYYY-MM-DD"
+                },
+                "end_date": {
+                    "type": "string",
+                    "description": "Fecha de fin en formato YYYY-MM-DD"
+                },
+                "query_filter": {
+                    "type": "string",
+                    "description": "Filtro opcional para las consultas de búsqueda (busca consultas que contengan este texto)"
+                },
+                "dimensions": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": SEARCH_CONSOLE_DIMENSIONS},
+                    "description": "Dimensiones por las que agrupar los datos, en orden (por defecto ['query'])"
+                }
+            },
+            "required": ["site_url", "start_date", "end_date"]
+        }
+    }
+]
+
+local_functions = [
+    {
+        "name": "analyze_loaded_data",
+        "description": "Filtra, agrupa, ordena y limita los datos de Search Console ya cargados en memoria, sin nuevas llamadas a la API",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "filters": {
+                    "type": "array",
+                    "description": "Condiciones que deben cumplir las filas (se combinan con AND)",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "column": {"type": "string", "description": "Columna de los datos cargados"},
+                            "operator": {"type": "string", "enum": list(LOCAL_OPERATORS) + ["contains"]},
+                            "value": {"type": ["string", "number"], "description": "Valor de comparación; el CTR está en porcentaje"}
+                        },
+                        "required": ["column", "operator", "value"]
+                    }
+                },
+                "group_by": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Columnas de dimensión por las que agrupar (suma clics e impresiones, pondera CTR y posición)"
+                },
+                "sort_by": {
+                    "type": "string",
+                    "enum": METRIC_COLUMNS,
+                    "description": "Métrica por la que ordenar"
+                },
+                "ascending": {
+                    "type": "boolean",
+                    "description": "Orden ascendente (por defecto descendente)"
+                },
+                "top_k": {
+                    "type": "integer",
+                    "description": "Número máximo de filas a devolver"
+                }
+            }
+        }
+    }
+]
+
+SYSTEM_PROMPT = "Eres un analista de datos especializado en Search Console. Siempre debes usar las funciones disponibles para obtener datos reales antes de responder preguntas sobre métricas de búsqueda."
+
+# --- ANÁLISIS EN STREAMING ---
+def start_analysis_stream(client, prompt, model=LLM_ANALYSIS_MODEL, group=None):
+    # La petición arranca en segundo plano y avanza mientras se dibujan métricas y gráficos
+    return client.stream([{"role": "user", "content": prompt}], model=model, group=group)
+
+# --- CACHÉ DE RESPUESTAS DEL LLM ---
+LLM_CACHE_MAX_ENTRIES = 512
+LLM_CACHE_MAX_DISK_ENTRIES = 10000
+LLM_CACHE_PERSIST = os.environ.get("LLM_CACHE_PERSIST", "1") == "1"
+
+def normalize_question(text):
+    # Misma pregunta con distinto formato, mayúsculas o acentos -> misma clave
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[¿?¡!;:]+|[.,](?!\d)', ' ', text)
+    return ' '.join(text.split())
+
+def make_llm_cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+class LLMCache:
+    # LRU en memoria con persistencia opcional en la base SQLite de la caché de respuestas
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, persist=LLM_CACHE_PERSIST):
+        self.max_entries = max_entries
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not self.persist:
+            return None
+        with closing(cache_connection()) as conn, conn:
+            row = conn.execute("SELECT value FROM llm_cache WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE cache_key = ?", (time.time(), key))
+        value = json.loads(row[0])
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if not self.persist:
+            return
+        with closing(cache_connection()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE cache_key NOT IN "
+                "(SELECT cache_key FROM llm_cache ORDER BY last_access DESC LIMIT ?)",
+                (LLM_CACHE_MAX_DISK_ENTRIES,)
+            )
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# Una caché por proceso, compartida por todas las sesiones
+_llm_cache = LLMCache()
+
+def get_llm_cache():
+    return _llm_cache
+
+def cached_analysis_stream(client, question, data_summary, prompt, model=LLM_ANALYSIS_MODEL, group=None):
+    # El análisis se reutiliza para la misma pregunta normalizada sobre el mismo resumen de datos y modelo
+    cache = get_llm_cache()
+    key = make_llm_cache_key('analysis', model, normalize_question(question), hashlib.sha256(data_summary.encode()).hexdigest())
+    cached = cache.get(key)
+    if cached is not None:
+        return iter([cached])
+
+    stream = start_analysis_stream(client, prompt, model=model, group=group)
+
+    def iter_and_store():
+        parts = []
+        for chunk in stream:
+            parts.append(chunk)
+            yield chunk
+        cache.put(key, ''.join(parts))
+
+    return iter_and_store()
+
+# --- INTÉRPRETE LOCAL DE INTENCIONES ---
+# Patrones sobre la pregunta normalizada (minúsculas y sin acentos): (patrón, métrica, ascendente)
+INTENT_SORTS = [
+    (r'(menor|peor|mas bajo)\s+ctr|ctr\s+mas bajo', 'ctr', True),
+    (r'(mayor|mejor|mas alto)\s+ctr|ctr\s+mas alto', 'ctr', False),
+    (r'mas\s+(clics|clicks)|(mayor|mas)\s+trafico', 'clicks', False),
+    (r'menos\s+(clics|clicks)|menor\s+trafico', 'clicks', True),
+    (r'mas\s+impresiones', 'impressions', False),
+    (r'menos\s+impresiones', 'impressions', True),
+    (r'peor(es)?\s+posicion', 'position', False),
+    (r'mejor(es)?\s+posicion', 'position', True),
+    (r'posicion', 'position', True),
+]
+INTENT_METRICS = {'ctr': 'ctr', 'clics': 'clicks', 'clicks': 'clicks', 'impresiones': 'impressions', 'posicion': 'position'}
+INTENT_DIMENSIONS = [
+    (r'\bpaginas?\b|\burls?\b', 'page'),
+    (r'\bpais(es)?\b', 'country'),
+    (r'\bdispositivos?\b', 'device'),
+]
+# Un dispositivo concreto es un filtro, no una agrupación; para aplicarlo hacen falta los datos por dispositivo
+INTENT_DEVICES = [
+    (r'\bmovil(es)?\b', 'MOBILE'),
+    (r'\bescritorio\b', 'DESKTOP'),
+    (r'\btablets?\b', 'TABLET'),
+]
+# Números con miles con punto ("1.000", "10.000") o decimales con coma ("2,5")
+NUMBER_PATTERN = r'\d{1,3}(?:\.\d{3})+(?![\d,])|\d+(?:[.,]\d+)?'
+THRESHOLD_PATTERNS = [
+    rf'(ctr|clics|clicks|impresiones|posicion)\s+(mayor|menor|superior|inferior)(?:es)?\s+(?:a|al|que|de)?\s*({NUMBER_PATTERN})',
+    rf'(mas|menos)\s+de\s+({NUMBER_PATTERN})\s*%?\s*(?:de\s+)?(ctr|clics|clicks|impresiones)',
+]
+# "Las 10 mejores consultas por CTR": la métrica decide la columna y mejores/peores el sentido
+RANKING_PATTERN = r'\b(mejor|peor)(?:es)?\s+(?:consultas|paginas|urls|resultados|keywords)\s+(?:por|segun|en)\s+(ctr|clics|clicks|impresiones|posicion)\b'
+# Solo se consume el número: un "mejores" o "peores" sin métrica queda sin interpretar
+TOP_K_PATTERN = r'\btop\s+(\d{1,4})\b|\b(\d{1,4})\s+(?=(?:(?:mejores|peores)\s+)?(?:consultas|paginas|urls|resultados|keywords)\b)'
+LAST_DAYS_PATTERN = r'ultim[oa]s\s+(\d{1,3})\s+dias'
+# Palabras sin contenido propio que pueden quedar en una pregunta ya interpretada; cualquier otra
+# (una marca, un tema, un país, una ruta...) es un filtro que solo el modelo sabe aplicar. Las métricas
+# y los comparativos (más, menos, mejores, entre...) no están: si ningún patrón los ha consumido,
+# la pregunta tiene una condición que el intérprete no entiende
+INTENT_FILLER_WORDS = {
+    'que', 'cual', 'cuales', 'de', 'del', 'la', 'las', 'el', 'los', 'en', 'con', 'y', 'o', 'a', 'al', 'por',
+    'son', 'es', 'top', 'me', 'mi', 'mis', 'un', 'una', 'unos', 'unas', 'se', 'lo', 'hay', 'ver', 'dime', 'dame',
+    'muestra', 'muestrame', 'ordena', 'ordenadas', 'ordenados', 'ordenar', 'lista', 'listado', 'quiero', 'mostrar',
+    'resultados', 'primeras', 'primeros', 'ranking', 'segun', 'tengo', 'tiene', 'tienen', 'sitio', 'web', 'todas',
+    'todos', 'consulta', 'consultas', 'keywords', 'contiene', 'contienen', 'incluye', 'incluyen',
+}
+# Referencias de fecha o filtros sin comillas que solo el modelo sabe interpretar
+AMBIGUOUS_DATE_PATTERN = (
+    r'\b(ayer|hoy|semana|semanas|mes|meses|ano|anos|trimestre|enero|febrero|marzo|abril|mayo|junio|julio|agosto|'
+    r'septiembre|octubre|noviembre|diciembre|\d{4}-\d{2}-\d{2}|compara\w*|versus|vs)\b'
+)
+AMBIGUOUS_FILTER_PATTERN = r'\b(contiene|contienen|incluye|incluyen|sobre|relacionad\w*)\b'
+QUOTED_TERM_PATTERN = r"['\"“‘«]([^'\"”’»]+)['\"”’»]"
+
+def detect_sort_intent(question):
+    normalized = normalize_question(question)
+    for pattern, metric, ascending in INTENT_SORTS:
+        if re.search(pattern, normalized):
+            return metric, ascending
+    return None
+
+def parse_number(value):
+    # "1.000" es mil, no uno: el punto seguido de grupos de tres cifras separa miles
+    if re.fullmatch(r'\d{1,3}(?:\.\d{3})+', value):
+        return float(value.replace('.', ''))
+    return float(value.replace(',', '.'))
+
+def unparsed_terms(text):
+    # Palabras que ningún patrón reconoció y que tampoco son de relleno
+    return [word for word in re.findall(r'\w+', text) if not word.isdigit() and word not in INTENT_FILLER_WORDS]
+
+def parse_intent(question, site_url, start_date, end_date):
+    # Construye los argumentos de la función sin llamar al LLM; devuelve None si la pregunta es ambigua,
+    # es decir, si menciona fechas o filtros sin comillas o le queda alguna palabra sin interpretar
+    quoted = re.search(QUOTED_TERM_PATTERN, question)
+    query_filter = quoted.group(1).strip() if quoted else None
+    normalized = normalize_question(re.sub(QUOTED_TERM_PATTERN, ' ', question))
+
+    days = re.search(LAST_DAYS_PATTERN, normalized)
+    if days:
+        end = datetime.today().date()
+        start_date, end_date = str(end - timedelta(days=int(days.group(1)))), str(end)
+        normalized = normalized.replace(days.group(0), ' ')
+    if re.search(AMBIGUOUS_DATE_PATTERN, normalized):
+        return None
+    if query_filter is None and re.search(AMBIGUOUS_FILTER_PATTERN, normalized):
+        return None
+
+    analysis = {}
+    ranking = re.search(RANKING_PATTERN, normalized)
+    if ranking:
+        quality, metric = ranking.groups()
+        column = INTENT_METRICS[metric]
+        # En posición lo mejor es el número más bajo
+        analysis['sort_by'], analysis['ascending'] = column, (quality == 'mejor') == (column == 'position')
+    else:
+        sort_intent = detect_sort_intent(normalized)
+        if sort_intent:
+            analysis['sort_by'], analysis['ascending'] = sort_intent
+
+    filters = []
+    for match in re.finditer(THRESHOLD_PATTERNS[0], normalized):
+        metric, comparison, value = match.groups()
+        op = '>' if comparison in ('mayor', 'superior') else '<'
+        filters.append({'column': INTENT_METRICS[metric], 'operator': op, 'value': parse_number(value)})
+    for match in re.finditer(THRESHOLD_PATTERNS[1], normalized):
+        comparison, value, metric = match.groups()
+        op = '>' if comparison == 'mas' else '<'
+        filters.append({'column': INTENT_METRICS[metric], 'operator': op, 'value': parse_number(value)})
+    devices = [device for pattern, device in INTENT_DEVICES if re.search(pattern, normalized)]
+    if len(devices) > 1:
+        return None
+    filters += [{'column': 'device', 'operator': '==', 'value': device} for device in devices]
+    if filters:
+        analysis['filters'] = filters
+
+    top_k = re.search(TOP_K_PATTERN, normalized)
+    if top_k:
+        analysis['top_k'] = int(top_k.group(1) or top_k.group(2))
+
+    remaining = normalized
+    # La clasificación va primero: contiene palabras que otros patrones consumirían por separado
+    recognized = [RANKING_PATTERN] + [pattern for pattern, _, _ in INTENT_SORTS] + THRESHOLD_PATTERNS + \
+        [TOP_K_PATTERN] + [pattern for pattern, _ in INTENT_DIMENSIONS + INTENT_DEVICES]
+    for pattern in recognized:
+        remaining = re.sub(pattern, ' ', remaining)
+    if unparsed_terms(remaining):
+        return None
+
+    fetch = {
+        'site_url': site_url,
+        'start_date': start_date,
+        'end_date': end_date,
+        'query_filter': query_filter
+    }
+    dimensions = [dimension for pattern, dimension in INTENT_DIMENSIONS if re.search(pattern, normalized)]
+    if devices and 'device' not in dimensions:
+        dimensions.append('device')
+    if dimensions:
+        fetch['dimensions'] = (['query'] if re.search(r'\bconsultas?\b', normalized) else []) + dimensions
+    return {'fetch': fetch, 'analysis': analysis}
+
+def plan_from_intent(intent, loaded_result, dimensions=None):
+    # Si los datos cargados ya cubren la petición, basta con analizarlos en local. Sin dimensiones en la
+    # pregunta se piden las que ha elegido quien llama, no las que tengan los datos cargados
+    fetch = intent['fetch']
+    if loaded_result is not None:
+        loaded_dimensions = dimension_columns(loaded_result['df'])
+        requested = fetch.get('dimensions') or dimensions or loaded_dimensions
+        if (loaded_result['start_date'], loaded_result['end_date']) == (fetch['start_date'], fetch['end_date']) and \
+                loaded_result['query_filter'] == fetch['query_filter'] and \
+                set(requested) == set(loaded_dimensions):
+            return {"name": "analyze_loaded_data", "arguments": json.dumps(intent['analysis'])}
+    return {
+        "name": "get_search_console_ctr",
+        "arguments": json.dumps(fetch),
+        "local_analysis": intent['analysis']
+    }
+
+# --- PLANIFICACIÓN Y EJECUCIÓN ---
+def build_planning_prompt(question, site_url, start_date, end_date, loaded_result=None):
+    # Devuelve el prompt junto con las herramientas disponibles y la elección de herramienta
+    prompt = f"""
+    Tengo una propiedad de Search Console en: {site_url}
+    Quiero analizar datos del {start_date} al {end_date}
+
+    Pregunta del usuario: {question}
+
+    Para responder a esta pregunta, necesitas usar la función get_search_console_ctr con los parámetros apropiados.
+    Si la pregunta menciona filtros específicos (como palabras clave), úsalos en query_filter.
+    """
+    # Si ya hay datos cargados para este rango, el modelo puede analizarlos en local
+    if loaded_result is not None:
+        loaded_df = loaded_result['df']
+        prompt += f"""
+    Ya hay datos cargados en memoria para esta propiedad y rango: {len(loaded_df)} filas con columnas {', '.join(loaded_df.columns)}.
+    Filtro aplicado al cargarlos: {loaded_result['query_filter'] or 'ninguno'}. El CTR está en porcentaje.
+    Si la pregunta puede responderse filtrando, agrupando, ordenando o limitando esos datos, usa analyze_loaded_data en lugar de volver a consultar Search Console.
+    """
+        return prompt, functions + local_functions, "required"
+    return prompt, functions, {"type": "function", "function": {"name": "get_search_console_ctr"}}
+
+def plan_question(client, question, site_url, start_date, end_date, loaded_result=None, model=LLM_PLANNING_MODEL, group=None, dimensions=None):
+    # Devuelve (plan, plan_key); plan_key es None cuando la pregunta se interpretó sin el modelo
+    intent = parse_intent(question, site_url, start_date, end_date)
+    if intent is not None:
+        return plan_from_intent(intent, loaded_result, dimensions), None
+
+    # La planificación se reutiliza para la misma pregunta, propiedad, rango y datos cargados
+    loaded_signature = None
+    if loaded_result is not None:
+        loaded_signature = [len(loaded_result['df']), list(loaded_result['df'].columns), loaded_result['query_filter']]
+    plan_key = make_llm_cache_key('plan', model, normalize_question(question), site_url, start_date, end_date, loaded_signature)
+    plan = get_llm_cache().get(plan_key)
+    if plan is not None:
+        return plan, plan_key
+
+    prompt, tools, tool_choice = build_planning_prompt(question, site_url, start_date, end_date, loaded_result)
+    with tracing.span("llm.plan", model=model):
+        message = client.complete(
+            [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            model=model,
+            tools=[{"type": "function", "function": func} for func in tools],
+            tool_choice=tool_choice,
+            group=group
+        )
+    if message.tool_calls:
+        return {"name": message.tool_calls[0].function.name, "arguments": message.tool_calls[0].function.arguments}, plan_key
+    return {"content": message.content}, plan_key
+
+def run_plan(search_client, plan, args, site_url, start_date, end_date, loaded_result=None, default_dimensions=None, incremental=False):
+    # Ejecuta el plan y devuelve (df_result, loaded) con los nuevos datos cargados o None si no cambian
+    if plan["name"] == "analyze_loaded_data" and loaded_result is not None:
+        with tracing.span("local.analysis") as stage:
+            df_result = run_local_analysis(
+                loaded_result['df'],
+                filters=args.get("filters"),
+                group_by=args.get("group_by"),
+                sort_by=args.get("sort_by"),
+                ascending=args.get("ascending", False),
+                top_k=args.get("top_k")
+            )
+            stage.set(rows=len(df_result))
+        return df_result, None
+
+    fetch_args = {
+        "site_url": args.get("site_url", site_url),
+        "start_date": args.get("start_date", start_date),
+        "end_date": args.get("end_date", end_date),
+        "query_filter": args.get("query_filter")
+    }
+    dimensions = list(args.get("dimensions") or default_dimensions or ['query'])
+    df_result = fetch_search_console(
+        search_client,
+        **fetch_args,
+        dimensions=dimensions,
+        incremental=incremental
+    )
+    if df_result.empty:
+        return df_result, None
+
+    loaded = dict(fetch_args, dimensions=dimensions, df=df_result)
+    if plan.get("local_analysis"):
+        with tracing.span("local.analysis") as stage:
+            df_result = run_local_analysis(df_result, **plan["local_analysis"])
+            stage.set(rows=len(df_result))
+    return df_result, loaded
+
+# --- CONTEXTO PARA EL ANÁLISIS ---
+# Tokens como máximo para los datos que se envían en el prompt de análisis
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("LLM_CONTEXT_TOKENS", "1500"))
+# Filas candidatas por sección antes de recortar al presupuesto
+CONTEXT_SECTION_ROWS = 30
+# Palabras de la pregunta (normalizadas) que no sirven para buscar coincidencias en los datos
+CONTEXT_STOPWORDS = {
+    'cuales', 'consulta', 'consultas', 'mayor', 'mayores', 'menor', 'menores', 'mejor', 'mejores', 'peor', 'peores',
+    'clics', 'clicks', 'impresiones', 'posicion', 'datos', 'para', 'como', 'donde', 'sobre', 'tiene', 'tienen',
+    'esta', 'estas', 'este', 'estos', 'entre', 'desde', 'hasta', 'ultimos', 'ultimas', 'dias', 'semana', 'todas',
+    'todos', 'pagina', 'paginas', 'muestra', 'muestrame', 'dame', 'cual', 'cuanto', 'cuantos', 'porque', 'hacer',
+    'puedo', 'deberia', 'mejorar', 'contiene', 'contienen', 'incluye', 'incluyen', 'trafico', 'keywords'
+}
+
+_encodings = {}
+
+def token_encoding(model=LLM_ANALYSIS_MODEL):
+    # Codificación de tiktoken del modelo, o None si el recuento será aproximado
+    if tiktoken is not None and model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            _encodings[model] = None
+    return _encodings.get(model)
+
+def count_tokens(text, model=LLM_ANALYSIS_MODEL):
+    # Cuenta con el tokenizador del modelo; sin él, ~4 caracteres por token
+    encoding = token_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+def encode_rows(df, columns):
+    # TSV sin índice: cabecera + una línea por fila, mucho más compacto en tokens que to_string()
+    return df[columns].to_csv(sep='\t', index=False, float_format='%.4g').splitlines()
+
+def question_terms(question):
+    # Términos entre comillas o, si no hay, las palabras con contenido de la pregunta
+    quoted = [term.strip().lower() for term in re.findall(QUOTED_TERM_PATTERN, question)]
+    if quoted:
+        return quoted
+    words = re.findall(r'\w+', question.lower())
+    return [word for word in words if len(word) >= 4 and not word.isdigit() and normalize_question(word) not in CONTEXT_STOPWORDS]
+
+def context_sections(df_result, question, trend_summary=None, rows=CONTEXT_SECTION_ROWS):
+    # Estratos de la muestra en orden de prioridad: (título, filas candidatas, columnas)
+    key_cols = dimension_columns(df_result)
+    columns = key_cols + METRIC_COLUMNS
+    sections = []
+
+    terms = question_terms(question)
+    if terms and key_cols:
+        labels = pd.Series(series_label(df_result, key_cols))
+        matches = df_result[labels.str.contains('|'.join(map(re.escape, terms)), case=False, regex=True).to_numpy()]
+        sections.append((f"Filas que coinciden con la pregunta ({len(matches)} en total)", matches.nlargest(rows, 'clicks'), columns))
+
+    sort_by, ascending = detect_sort_intent(question) or ('clicks', False)
+    ranked = df_result.nsmallest(rows, sort_by) if ascending else df_result.nlargest(rows, sort_by)
+    sections.append((f"Primeras por {sort_by}", ranked, columns))
+
+    # Valores atípicos: mucho volumen de impresiones con un CTR en el cuartil inferior
+    outliers = df_result[
+        (df_result['impressions'] >= df_result['impressions'].quantile(0.9)) &
+        (df_result['ctr'] <= df_result['ctr'].quantile(0.25))
+    ]
+    sections.append(("Muchas impresiones y CTR bajo", outliers.nlargest(rows, 'impressions'), columns))
+
+    if trend_summary is not None and not trend_summary.empty:
+        trend_keys = [col for col in trend_summary.columns if col not in TREND_COLUMNS]
+        movers = trend_keys + ['clicks_previous', 'clicks_current', 'ctr_previous', 'ctr_current', 'ctr_delta', 'position_delta']
+        anomalous = trend_summary[trend_summary['anomalies'] > 0]
+        sections += [
+            ("Mayores caídas de CTR (2ª mitad del período vs 1ª)", trend_summary.nsmallest(rows, 'ctr_delta'), movers),
+            ("Mayores subidas de clics (2ª mitad del período vs 1ª)", trend_summary.nlargest(rows, 'clicks_delta'), movers),
+            (f"Series con días de CTR anómalo ({len(anomalous)} en total)", anomalous.head(rows), trend_keys + ['anomalies', 'last_anomaly', 'worst_z']),
+        ]
+    return [section for section in sections if not section[1].empty]
+
+def build_data_summary(df_result, question="", trend_summary=None, token_budget=CONTEXT_TOKEN_BUDGET, model=LLM_ANALYSIS_MODEL):
+    # Resumen global + muestra estratificada en TSV, recortada para no pasar de token_budget
+    key_cols = dimension_columns(df_result)
+    clicks, impressions = int(df_result['clicks'].sum()), int(df_result['impressions'].sum())
+    quantiles = df_result[METRIC_COLUMNS].quantile([0.1, 0.5, 0.9]).T
+    quantiles.columns = ['p10', 'p50', 'p90']
+    quantiles['max'] = df_result[METRIC_COLUMNS].max()
+    lines = [
+        f"Datos obtenidos: {len(df_result)} filas ({', '.join(key_cols) or 'totales'})",
+        f"Totales: clics={clicks}, impresiones={impressions}, "
+        f"CTR global={clicks / impressions * 100 if impressions else 0:.2f}%, posición media={df_result['position'].mean():.1f}",
+        "Distribución por fila:",
+        *encode_rows(quantiles.reset_index(names='metrica'), ['metrica', 'p10', 'p50', 'p90', 'max'])
+    ]
+    used = count_tokens('\n'.join(lines), model)
+
+    # En cada ronda entra una fila nueva de cada sección, así ningún estrato se queda fuera por otro
+    blocks = []
+    for title, frame, columns in context_sections(df_result, question, trend_summary):
+        header, *rows = encode_rows(frame, columns)
+        blocks.append({'title': f"{title}:", 'header': header, 'rows': rows, 'next': 0, 'kept': []})
+    seen = set()
+    added = True
+    while added:
+        added = False
+        for block in blocks:
+            while block['next'] < len(block['rows']):
+                row = block['rows'][block['next']]
+                block['next'] += 1
+                if row in seen:
+                    continue
+                cost = count_tokens(row, model) + (0 if block['kept'] else count_tokens(block['title'] + '\n' + block['header'], model))
+                if used + cost > token_budget:
+                    block['next'] = len(block['rows'])
+                    break
+                used += cost
+                seen.add(row)
+                block['kept'].append(row)
+                added = True
+                break
+
+    for block in blocks:
+        if block['kept']:
+            lines += ['', block['title'], block['header'], *block['kept']]
+    tracing.annotate(context_tokens=used)
+    return '\n'.join(lines)
+
+def build_analysis_prompt(question, data_summary):
+    return f"""
+    Basándote en estos datos de Search Console, responde a la pregunta: "{question}"
+    {data_summary}
+    Proporciona un análisis conciso y accionable.
+    """
@@ -0,0 +1,178 @@
+# Cliente asíncrono del LLM: un bucle de eventos por proceso, timeouts por llamada, reintentos y cancelación.
+# Expone métodos síncronos para Streamlit; base_url permite usar cualquier servidor compatible con OpenAI (p. ej. un mock local).
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import queue
+import random
+import threading
+import time
+
+import openai
+
+import tracing
+
+LLM_BASE_URL = os.environ.get("OPENAI_BASE_URL") or None
+# Modelo rápido y barato para elegir la función y sus argumentos; el grande solo para el análisis narrativo
+LLM_PLANNING_MODEL = os.environ.get("LLM_PLANNING_MODEL", "gpt-4o-mini")
+LLM_ANALYSIS_MODEL = os.environ.get("LLM_ANALYSIS_MODEL", "gpt-4")
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "30"))
+# En streaming el timeout se aplica a la espera de cada fragmento, no a la respuesta completa
+LLM_STREAM_IDLE_SECONDS = float(os.environ.get("LLM_STREAM_IDLE_SECONDS", "30"))
+LLM_MAX_RETRIES = 3
+LLM_RETRY_BASE_SECONDS = 0.5
+LLM_RETRY_MAX_SECONDS = 8.0
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# --- BUCLE DE EVENTOS COMPARTIDO ---
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop():
+    # Un bucle asyncio en un hilo propio; las sesiones de Streamlit le envían corrutinas desde sus hilos
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name='llm-loop').start()
+        return _loop
+
+# --- CLIENTE ---
+_STREAM_END = object()
+
+class LLMClient:
+    def __init__(self, api_key, base_url=None, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES):
+        # Los reintentos los gestiona el wrapper, así que el SDK no reintenta por su cuenta
+        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    async def _with_retries(self, call, timeout):
+        # Timeout por intento y backoff exponencial con jitter completo ante errores transitorios
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await asyncio.wait_for(call(), timeout)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise TimeoutError(f"El modelo no respondió en {timeout:g}s") from None
+                    raise
+                await asyncio.sleep(random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt)))
+
+    def _submit(self, coro, group):
+        future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+        if group is not None:
+            with self._pending_lock:
+                self._pending.setdefault(group, set()).add(future)
+            future.add_done_callback(lambda done: self._forget(group, done))
+        return future
+
+    def _forget(self, group, future):
+        with self._pending_lock:
+            futures = self._pending.get(group)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._pending[group]
+
+    def cancel(self, group):
+        # Cancela las peticiones en curso de un grupo (p. ej. la sesión que ha cambiado de pregunta)
+        with self._pending_lock:
+            futures = self._pending.pop(group, set())
+        for future in futures:
+            future.cancel()
+        return len(futures)
+
+    def complete(self, messages, model=LLM_PLANNING_MODEL, tools=None, tool_choice=None, timeout=None, group=None):
+        # Llamada no streaming; devuelve el mensaje de la primera opción
+        kwargs = {}
+        if tools:
+            kwargs.update(tools=tools, tool_choice=tool_choice)
+
+        async def call():
+            return await self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+
+        response = self._submit(self._with_retries(call, timeout or self.timeout), group).result()
+        if response.usage:
+            tracing.add(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+        return response.choices[0].message
+
+    def stream(self, messages, model=LLM_ANALYSIS_MODEL, idle_timeout=LLM_STREAM_IDLE_SECONDS, group=None):
+        # La petición avanza en el bucle de eventos mientras quien llama consume un generador síncrono.
+        # Solo se reintenta la apertura: una vez llegado texto, reintentar lo duplicaría
+        chunks = queue.Queue()
+        usage = {}
+        started_at = time.perf_counter()
+
+        async def open_stream():
+            return await self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, stream_options={"include_usage": True}
+            )
+
+        async def produce():
+            stream = await self._with_retries(open_stream, idle_timeout)
+            try:
+                events = stream.__aiter__()
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.__anext__(), idle_timeout)
+                    except StopAsyncIteration:
+                        return
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(f"El modelo dejó de responder durante {idle_timeout:g}s") from None
+                    if event.choices and event.choices[0].delta.content:
+                        chunks.put(event.choices[0].delta.content)
+                    if event.usage:
+                        usage.update(prompt_tokens=event.usage.prompt_tokens, completion_tokens=event.usage.completion_tokens)
+            finally:
+                await stream.close()
+
+        def finish(future):
+            if future.cancelled():
+                chunks.put(concurrent.futures.CancelledError("Análisis cancelado"))
+            elif future.exception() is not None:
+                chunks.put(future.exception())
+            chunks.put(_STREAM_END)
+
+        future = self._submit(produce(), group)
+        future.add_done_callback(finish)
+
+        def iter_chunks():
+            # Si el generador se cierra antes de tiempo (rerun de Streamlit), la petición se cancela.
+            # Los tokens y el tiempo hasta el primer fragmento se anotan en la etapa que consume el stream
+            first = True
+            try:
+                while True:
+                    item = chunks.get()
+                    if item is _STREAM_END:
+                        tracing.add(**usage)
+                        return
+                    if isinstance(item, BaseException):
+                        raise item
+                    if first:
+                        tracing.annotate(first_token_ms=round((time.perf_counter() - started_at) * 1000, 1))
+                        first = False
+                    yield item
+            finally:
+                future.cancel()
+
+        return iter_chunks()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_llm_client(api_key, base_url=LLM_BASE_URL):
+    # Un cliente (y su pool de conexiones) por clave y servidor, reutilizado entre reruns y sesiones
+    fingerprint = hashlib.sha256(f"{api_key}\n{base_url or ''}".encode()).hexdigest()
+    with _clients_lock:
+        if fingerprint not in _clients:
+            _clients[fingerprint] = LLMClient(api_key, base_url=base_url or None)
+        return _clients[fingerprint]
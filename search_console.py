@@ -0,0 +1,865 @@
+# Capa de datos de Google Search Console: cliente, consultas, caché y transformaciones.
+# No depende de Streamlit, así que la reutilizan tanto app.py como los procesos por lotes (cli.py).
+from datetime import datetime, timedelta
+from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import httplib2
+import numpy as np
+import pandas as pd
+import hashlib
+import io
+import json
+import operator
+import os
+import pickle
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+
+import tracing
+
+SEARCH_CONSOLE_SCOPES = ["https://www.googleapis.com/auth/webmasters.readonly"]
+
+# --- LÍMITE DE CUOTA Y REINTENTOS ---
+# Search Console permite 1.200 consultas por minuto por usuario y 30.000.000 diarias por proyecto
+SEARCH_CONSOLE_QPS = 20
+SEARCH_CONSOLE_QPD = 30000000
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 32.0
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# La lista de propiedades cambia muy poco: se reutiliza durante este tiempo
+SITES_CACHE_TTL_SECONDS = 15 * 60
+
+class TokenBucket:
+    # Limitador de tasa compartido entre hilos: repone `rate` tokens por segundo hasta `capacity`
+    def __init__(self, rate, capacity, daily_limit=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.daily_limit = daily_limit
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.day = datetime.today().date()
+        self.used_today = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                today = datetime.today().date()
+                if today != self.day:
+                    self.day, self.used_today = today, 0
+                if self.daily_limit is not None and self.used_today >= self.daily_limit:
+                    raise RuntimeError("Se alcanzó la cuota diaria de consultas de Search Console")
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Un único limitador por proceso, compartido por todas las sesiones y todos los hilos
+_rate_limiter = TokenBucket(SEARCH_CONSOLE_QPS, SEARCH_CONSOLE_QPS, daily_limit=SEARCH_CONSOLE_QPD)
+
+def get_rate_limiter():
+    return _rate_limiter
+
+# --- CLIENTE DE GOOGLE REUTILIZABLE ---
+# Conexiones keep-alive por credencial; con MAX_WORKERS ningún pool de consultas se queda esperando
+HTTP_POOL_SIZE = MAX_WORKERS
+# Hilos para las consultas que se adelantan en segundo plano (lista de propiedades)
+_background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='gsc-prefetch')
+
+def credentials_fingerprint(service_account_info):
+    return hashlib.sha256(json.dumps(service_account_info, sort_keys=True).encode()).hexdigest()
+
+class MeteredHttp(AuthorizedHttp):
+    # Anota en la traza activa los bytes recibidos de la API
+    def request(self, *args, **kwargs):
+        response, content = super().request(*args, **kwargs)
+        tracing.add(bytes=len(content or b''))
+        return response, content
+
+class HttpPool:
+    # Conexiones autorizadas compartidas por todos los hilos. Streamlit usa un hilo nuevo en cada rerun
+    # y los pools de consultas también, así que una conexión por hilo se abriría de nuevo cada vez
+    def __init__(self, factory, size=HTTP_POOL_SIZE):
+        self.factory = factory
+        self.size = size
+        self.created = 0
+        # LIFO: se reutiliza primero la conexión usada más recientemente, que sigue abierta
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        # httplib2 no es thread-safe: cada conexión la usa un único hilo mientras dura la petición
+        http = self._checkout()
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.factory()
+        # Todas las conexiones están en uso: se espera a que vuelva una
+        return self._idle.get()
+
+class SearchConsoleClient:
+    # Un servicio por credencial (el discovery se analiza una vez) y un pool de conexiones keep-alive
+    # `http` fija un transporte sin credenciales (p. ej. un HttpMock) para pruebas y benchmarks sin red
+    def __init__(self, service_account_info, limiter=None, http=None):
+        self.fingerprint = credentials_fingerprint(service_account_info)
+        self.credentials = None
+        if http is None:
+            self.credentials = service_account.Credentials.from_service_account_info(
+                service_account_info,
+                scopes=SEARCH_CONSOLE_SCOPES
+            )
+        self.limiter = limiter or get_rate_limiter()
+        # Se construye una vez por credencial y proceso, así que queda como traza propia
+        with tracing.trace("gsc.build"):
+            self.service = build(
+                'searchconsole', 'v1', credentials=self.credentials, http=http, cache_discovery=False, static_discovery=True
+            )
+        self._fixed_http = http
+        self._http_pool = HttpPool(lambda: MeteredHttp(self.credentials, http=httplib2.Http(timeout=60)))
+        self._sites_future = None
+        self._sites_fetched_at = 0.0
+        self._sites_lock = threading.Lock()
+
+    @contextmanager
+    def _http(self):
+        if self._fixed_http is not None:
+            yield self._fixed_http
+            return
+        with self._http_pool.connection() as http:
+            yield http
+
+    def execute(self, request):
+        # Respeta la cuota y reintenta los 429/5xx con backoff exponencial y jitter completo
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            # Cada petición enviada, también los reintentos, consume una unidad de cuota
+            tracing.add(quota_units=1)
+            try:
+                with self._http() as http:
+                    return request.execute(http=http)
+            except HttpError as e:
+                if e.resp.status not in RETRYABLE_STATUSES or attempt == MAX_RETRIES:
+                    raise
+                tracing.add(retries=1)
+                time.sleep(random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)))
+
+    def _fetch_sites(self):
+        response = self.execute(self.service.sites().list())
+        sites = response.get('siteEntry', [])
+        self._sites_fetched_at = time.monotonic()
+        return [site['siteUrl'] for site in sites if site.get('permissionLevel') in ['siteOwner', 'siteFullUser']]
+
+    def _sites_stale(self):
+        future = self._sites_future
+        if future is None:
+            return True
+        if not future.done():
+            return False
+        return future.exception() is not None or time.monotonic() - self._sites_fetched_at > SITES_CACHE_TTL_SECONDS
+
+    def prefetch_sites(self, refresh=False):
+        # Lanza sites().list() en segundo plano si no hay una lista vigente; no bloquea
+        with self._sites_lock:
+            if refresh or self._sites_stale():
+                self._sites_future = _background_executor.submit(self._fetch_sites)
+            return self._sites_future
+
+    def list_sites(self, refresh=False):
+        # Reutiliza la lista cacheada (o la petición en curso) y solo la vuelve a pedir al caducar
+        return list(self.prefetch_sites(refresh).result())
+
+    def invalidate_sites(self):
+        with self._sites_lock:
+            self._sites_future = None
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_account_info):
+    # Los clientes viven lo que dura el proceso, así que sobreviven a los reruns de Streamlit
+    fingerprint = credentials_fingerprint(service_account_info)
+    with _clients_lock:
+        if fingerprint not in _clients:
+            _clients[fingerprint] = SearchConsoleClient(service_account_info)
+        return _clients[fingerprint]
+
+# --- CONSULTAS A SEARCH CONSOLE ---
+# La API devuelve como máximo 25.000 filas por petición; el resto se pide avanzando startRow
+SEARCH_CONSOLE_PAGE_SIZE = 25000
+SEARCH_CONSOLE_DIMENSIONS = ['query', 'page', 'country', 'device', 'date', 'searchAppearance']
+# Dimensiones con pocos valores distintos que se repiten en muchas filas
+CATEGORICAL_DIMENSIONS = {'country', 'device', 'searchAppearance', 'site_url'}
+METRIC_COLUMNS = ['clicks', 'impressions', 'ctr', 'position']
+
+def build_query_request(start_date, end_date, dimensions, query_filter=None):
+    request = {
+        'startDate': start_date,
+        'endDate': end_date,
+        'dimensions': list(dimensions),
+    }
+    if query_filter:
+        request['dimensionFilterGroups'] = [{
+            'filters': [{
+                'dimension': 'query',
+                'operator': 'contains',
+                'expression': query_filter
+            }]
+        }]
+    return request
+
+def rows_to_dataframe(rows, dimensions=('query',)):
+    # Convierte la página en bloque: un array por columna y escalado/redondeo como operaciones vectoriales
+    rows = [row for row in rows if row.get('keys')]
+    count = len(rows)
+    keys = [row['keys'] for row in rows]
+    columns = {dimension: np.array([k[i] for k in keys], dtype=object) for i, dimension in enumerate(dimensions)}
+    metrics = {
+        metric: np.fromiter((row.get(metric, 0) for row in rows), dtype=np.float64, count=count)
+        for metric in METRIC_COLUMNS
+    }
+    columns.update({
+        'clicks': metrics['clicks'].astype(np.int32),
+        'impressions': metrics['impressions'].astype(np.int32),
+        'ctr': np.round(metrics['ctr'] * 100, 2).astype(np.float32),
+        'position': np.round(metrics['position'], 1).astype(np.float32)
+    })
+
+    # Las consultas vacías se descartan con una máscara antes de construir el DataFrame
+    if 'query' in columns:
+        keep = columns['query'].astype(bool)
+        if not keep.all():
+            columns = {name: values[keep] for name, values in columns.items()}
+    if 'date' in columns:
+        columns['date'] = pd.to_datetime(columns['date'], format='%Y-%m-%d')
+    return pd.DataFrame(columns)
+
+def compact_dimensions(df, dimensions):
+    # Las claves repetidas pasan a categóricas; se hace tras unir las páginas para compartir categorías
+    for dimension in dimensions:
+        if dimension not in df.columns or dimension == 'date':
+            continue
+        column = df[dimension]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            continue
+        if dimension in CATEGORICAL_DIMENSIONS or column.nunique() < len(column) // 2:
+            df[dimension] = column.astype('category')
+    return df
+
+def dimension_columns(df):
+    return [col for col in df.columns if col not in METRIC_COLUMNS]
+
+def iter_search_console_pages(client, site_url, request, page_size=SEARCH_CONSOLE_PAGE_SIZE, max_rows=None):
+    # Entrega cada página como un DataFrame en cuanto llega, sin esperar al resultado completo
+    start_row = 0
+    while max_rows is None or start_row < max_rows:
+        row_limit = page_size if max_rows is None else min(page_size, max_rows - start_row)
+        body = dict(request, startRow=start_row, rowLimit=row_limit)
+        with tracing.span("gsc.query", start_row=start_row) as stage:
+            response = client.execute(client.service.searchanalytics().query(siteUrl=site_url, body=body))
+            rows = response.get('rows', [])
+            stage.add(rows=len(rows))
+        if not rows:
+            break
+
+        with tracing.span("gsc.to_dataframe", rows=len(rows)):
+            chunk = rows_to_dataframe(rows, request['dimensions'])
+        if not chunk.empty:
+            yield chunk
+
+        # Una página incompleta indica que ya no quedan más filas
+        if len(rows) < row_limit:
+            break
+        start_row += len(rows)
+
+# --- CACHÉ EN DISCO DE RESPUESTAS ---
+CACHE_DB_PATH = os.environ.get(
+    "GSC_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "search_console.sqlite")
+)
+CACHE_TTL_SECONDS = 6 * 60 * 60
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Los datos de Search Console tienen 2-3 días de retraso; lo anterior ya no cambia
+DATA_LAG_DAYS = 3
+
+def cache_connection():
+    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS responses (
+            cache_key TEXT PRIMARY KEY,
+            site_url TEXT,
+            start_date TEXT,
+            end_date TEXT,
+            dimensions TEXT,
+            query_filter TEXT,
+            expires_at REAL,
+            last_access REAL,
+            size_bytes INTEGER,
+            payload BLOB
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_facts (
+            credential TEXT,
+            site_url TEXT,
+            dimensions TEXT,
+            query_filter TEXT,
+            day TEXT,
+            fetched_at REAL,
+            size_bytes INTEGER,
+            payload BLOB,
+            PRIMARY KEY (credential, site_url, dimensions, query_filter, day)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            value TEXT,
+            last_access REAL
+        )
+    """)
+    return conn
+
+def make_cache_key(fingerprint, site_url, start_date, end_date, dimensions, query_filter, max_rows=None, incremental=False):
+    # La credencial forma parte de la clave: una cuenta sin acceso a la propiedad no lee lo que guardó otra.
+    # El modo incremental también: agrega días sueltos y su resultado no coincide con el de una consulta única
+    return json.dumps([fingerprint, site_url, start_date, end_date, list(dimensions), query_filter or "", max_rows, incremental])
+
+def is_range_final(end_date):
+    # Un rango que termina antes de la ventana de retraso nunca vuelve a cambiar
+    end = datetime.strptime(str(end_date), "%Y-%m-%d").date()
+    return (datetime.today().date() - end).days >= DATA_LAG_DAYS
+
+def cache_get(cache_key):
+    now = time.time()
+    with closing(cache_connection()) as conn, conn:
+        row = conn.execute(
+            "SELECT payload, expires_at FROM responses WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        payload, expires_at = row
+        if expires_at is not None and expires_at < now:
+            conn.execute("DELETE FROM responses WHERE cache_key = ?", (cache_key,))
+            return None
+        conn.execute("UPDATE responses SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+    return pickle.loads(payload)
+
+def cache_put(cache_key, site_url, start_date, end_date, dimensions, query_filter, df):
+    now = time.time()
+    payload = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+    expires_at = None if is_range_final(end_date) else now + CACHE_TTL_SECONDS
+    with closing(cache_connection()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (cache_key, site_url, start_date, end_date, json.dumps(list(dimensions)),
+             query_filter or "", expires_at, now, len(payload), payload)
+        )
+        _evict_cache(conn, now)
+
+def _evict_cache(conn, now):
+    # Primero se eliminan las respuestas caducadas y después, entre respuestas y días sueltos, lo usado
+    # hace más tiempo hasta que las dos tablas juntas respetan el tamaño máximo
+    conn.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+    total = conn.execute(
+        "SELECT (SELECT COALESCE(SUM(size_bytes), 0) FROM responses) + (SELECT COALESCE(SUM(size_bytes), 0) FROM daily_facts)"
+    ).fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    for table, rowid, size_bytes, _ in conn.execute(
+        "SELECT 'responses', rowid, size_bytes, last_access AS used FROM responses "
+        "UNION ALL SELECT 'daily_facts', rowid, size_bytes, fetched_at AS used FROM daily_facts "
+        "ORDER BY used ASC"
+    ).fetchall():
+        conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+        total -= size_bytes
+        if total <= CACHE_MAX_BYTES:
+            break
+
+# --- SINCRONIZACIÓN INCREMENTAL POR DÍA ---
+def date_range(start_date, end_date):
+    start = datetime.strptime(str(start_date), "%Y-%m-%d").date()
+    end = datetime.strptime(str(end_date), "%Y-%m-%d").date()
+    return [str(start + timedelta(days=i)) for i in range((end - start).days + 1)]
+
+def load_stored_days(fingerprint, site_url, dimensions, query_filter, days):
+    # Solo se reutilizan los días fuera de la ventana de retraso; los recientes se vuelven a pedir
+    stored = {}
+    with closing(cache_connection()) as conn:
+        for day in days:
+            if not is_range_final(day):
+                continue
+            row = conn.execute(
+                "SELECT payload FROM daily_facts WHERE credential = ? AND site_url = ? AND dimensions = ? AND query_filter = ? AND day = ?",
+                (fingerprint, site_url, json.dumps(list(dimensions)), query_filter or "", day)
+            ).fetchone()
+            if row is not None:
+                stored[day] = pickle.loads(row[0])
+    return stored
+
+def store_day(fingerprint, site_url, dimensions, query_filter, day, df):
+    now = time.time()
+    payload = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+    with closing(cache_connection()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO daily_facts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (fingerprint, site_url, json.dumps(list(dimensions)), query_filter or "", day, now, len(payload), payload)
+        )
+        _evict_cache(conn, now)
+
+def fetch_day(client, site_url, day, dimensions, query_filter=None):
+    request = build_query_request(day, day, ['date'] + [d for d in dimensions if d != 'date'], query_filter)
+    chunks = list(iter_search_console_pages(client, site_url, request))
+    if not chunks:
+        return pd.DataFrame(columns=request['dimensions'] + METRIC_COLUMNS)
+    return compact_dimensions(pd.concat(chunks, ignore_index=True, copy=False), request['dimensions'])
+
+def sync_search_console_days(client, site_url, start_date, end_date, dimensions=('query',), query_filter=None):
+    # Devuelve la tabla diaria del rango pidiendo a la API solo los días que faltan
+    days = date_range(start_date, end_date)
+    frames = load_stored_days(client.fingerprint, site_url, dimensions, query_filter, days)
+    missing = [day for day in days if day not in frames]
+    if missing:
+        # Los días que faltan se piden en paralelo; el limitador mantiene la cuota
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(missing))) as executor:
+            futures = {
+                executor.submit(tracing.in_current_context(fetch_day), client, site_url, day, dimensions, query_filter): day
+                for day in missing
+            }
+            for future in as_completed(futures):
+                day = futures[future]
+                frames[day] = future.result()
+                store_day(client.fingerprint, site_url, dimensions, query_filter, day, frames[day])
+
+    frames = [frames[day] for day in days if not frames[day].empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True, copy=False)
+
+def aggregate_daily(df, dimensions=('query',)):
+    # Suma clics e impresiones; CTR y posición se recalculan ponderados por impresiones
+    if df.empty:
+        return pd.DataFrame(columns=list(dimensions) + METRIC_COLUMNS)
+    weighted = df.assign(position_weight=df['position'] * df['impressions'])
+    grouped = weighted.groupby(list(dimensions), sort=False, observed=True).agg(
+        clicks=('clicks', 'sum'),
+        impressions=('impressions', 'sum'),
+        position_weight=('position_weight', 'sum')
+    ).reset_index()
+    impressions = grouped['impressions'].where(grouped['impressions'] > 0)
+    grouped['ctr'] = (grouped['clicks'] / impressions * 100).fillna(0).round(2).astype(np.float32)
+    grouped['position'] = (grouped['position_weight'] / impressions).fillna(0).round(1).astype(np.float32)
+    return grouped.drop(columns='position_weight')
+
+# --- ALMACÉN COMPARTIDO ENTRE SESIONES ---
+# Memoria máxima para los resultados que comparten todas las sesiones del proceso
+RESULT_STORE_MAX_BYTES = int(os.environ.get("GSC_RESULT_STORE_MB", "1024")) * 1024 * 1024
+
+def shared_frame(df):
+    # Vista sin copiar los datos: con copy-on-write (pandas 3) modificar la vista copia solo la
+    # columna afectada, así que ni el almacén ni las demás sesiones ven el cambio
+    return df.copy(deep=False)
+
+class ResultStore:
+    # Resultados por credencial y consulta compartidos por todas las sesiones de Streamlit del proceso.
+    # Si varias sesiones piden lo mismo a la vez, solo una consulta y las demás esperan su resultado
+    def __init__(self, max_bytes=RESULT_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = self.coalesced = self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader, expires_at=None):
+        # Devuelve (df, origen) con origen 'memory', 'coalesced' o 'loaded'; los errores no se guardan
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return shared_frame(entry[0]), 'memory'
+            if entry is not None:
+                self._drop(key)
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return shared_frame(future.result()), 'coalesced'
+
+        try:
+            df = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            self._put(key, df, expires_at)
+        future.set_result(df)
+        return shared_frame(df), 'loaded'
+
+    def _put(self, key, df, expires_at):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (df, expires_at, size)
+        self._bytes += size
+        # Se descartan los resultados usados hace más tiempo hasta respetar el máximo
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def usage(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+            }
+
+# Un único almacén por proceso, como el limitador de cuota
+_result_store = ResultStore()
+
+def get_result_store():
+    return _result_store
+
+def fetch_search_console(client, site_url, start_date, end_date, query_filter=None, max_rows=None, dimensions=None, incremental=False, shared=True):
+    # Núcleo de la consulta; los errores se propagan al llamador. El DataFrame devuelto comparte
+    # los datos con otras sesiones: se puede transformar, pero las modificaciones no se propagan.
+    # Con shared=False no pasa por el almacén en memoria (procesos por lotes que no vuelven a leerlo)
+    dimensions = list(dimensions or ['query'])
+    # La clave incluye la credencial, así que ni el almacén compartido ni la caché en disco de debajo
+    # entregan datos de una propiedad a una cuenta que no tiene acceso a ella
+    cache_key = make_cache_key(client.fingerprint, site_url, start_date, end_date, dimensions, query_filter, max_rows, incremental)
+    expires_at = None if is_range_final(end_date) else time.time() + CACHE_TTL_SECONDS
+    with tracing.span("gsc.fetch", site_url=site_url, dimensions=','.join(dimensions), incremental=incremental) as stage:
+        def load():
+            return _fetch_search_console(client, cache_key, site_url, start_date, end_date, query_filter, max_rows, dimensions, incremental, stage)
+
+        if shared:
+            df, source = get_result_store().get_or_load(cache_key, load, expires_at)
+            if source != 'loaded':
+                stage.set(cache=source)
+        else:
+            df = load()
+        stage.set(rows=len(df))
+    return df
+
+def _fetch_search_console(client, cache_key, site_url, start_date, end_date, query_filter, max_rows, dimensions, incremental, stage):
+    cached = cache_get(cache_key)
+    stage.set(cache='hit' if cached is not None else 'miss')
+    if cached is not None:
+        return cached
+
+    if incremental:
+        daily = sync_search_console_days(client, site_url, start_date, end_date, dimensions, query_filter)
+        df = aggregate_daily(daily, dimensions)
+        del daily
+        if not df.empty:
+            df = df.sort_values('clicks', ascending=False).reset_index(drop=True)
+            if max_rows is not None:
+                df = df.head(max_rows)
+    else:
+        # Cada página ya llega convertida; solo se unen una vez al final
+        request = build_query_request(start_date, end_date, dimensions, query_filter)
+        chunks = list(iter_search_console_pages(client, site_url, request, max_rows=max_rows))
+        if chunks:
+            df = pd.concat(chunks, ignore_index=True, copy=False)
+            del chunks
+            df = df.sort_values('clicks', ascending=False).reset_index(drop=True)
+        else:
+            df = pd.DataFrame()
+    df = compact_dimensions(df, dimensions)
+
+    cache_put(cache_key, site_url, start_date, end_date, dimensions, query_filter, df)
+    return df
+
+def fetch_multiple_sites(client, site_urls, start_date, end_date, query_filter=None, max_rows=None, dimensions=None, incremental=False, max_workers=MAX_WORKERS):
+    # Consulta varias propiedades a la vez en un pool acotado; los errores se devuelven por propiedad
+    frames, errors = [], {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(site_urls)))) as executor:
+        futures = {
+            executor.submit(
+                tracing.in_current_context(fetch_search_console), client, url, start_date, end_date, query_filter, max_rows, dimensions, incremental
+            ): url
+            for url in site_urls
+        }
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                df = future.result()
+            except Exception as e:
+                errors[url] = str(e)
+                continue
+            if not df.empty:
+                frames.append(df.assign(site_url=url))
+
+    if not frames:
+        return pd.DataFrame(), errors
+    df = pd.concat(frames, ignore_index=True, copy=False)
+    df = df[['site_url'] + [col for col in df.columns if col != 'site_url']]
+    df = compact_dimensions(df, ['site_url'] + list(dimensions or ['query']))
+    return df.sort_values('clicks', ascending=False).reset_index(drop=True), errors
+
+# --- MOTOR DE ANÁLISIS LOCAL ---
+LOCAL_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+def apply_filters(df, filters):
+    # Cada filtro se evalúa como una máscara vectorizada sobre la columna completa
+    mask = np.ones(len(df), dtype=bool)
+    for item in filters or []:
+        column, op, value = item.get('column'), item.get('operator'), item.get('value')
+        if column not in df.columns:
+            raise ValueError(f"La columna '{column}' no existe en los datos cargados")
+        series = df[column]
+        if op == 'contains':
+            mask &= series.astype(str).str.contains(str(value), case=False, regex=False).to_numpy()
+        elif op in LOCAL_OPERATORS:
+            if column in METRIC_COLUMNS:
+                value = float(value)
+            elif column == 'date':
+                value = pd.Timestamp(value)
+            mask &= LOCAL_OPERATORS[op](series, value).to_numpy()
+        else:
+            raise ValueError(f"Operador no soportado: {op}")
+    return df[mask]
+
+def run_local_analysis(df, filters=None, group_by=None, sort_by=None, ascending=False, top_k=None):
+    # Responde preguntas de seguimiento sobre los datos ya cargados sin volver a llamar a la API
+    result = apply_filters(df, filters)
+    if group_by:
+        # Solo se agrupa por dimensiones: las métricas son lo que se suma en cada grupo
+        missing = [col for col in group_by if col not in dimension_columns(result)]
+        if missing:
+            raise ValueError(f"No se puede agrupar por columnas que no son dimensiones de los datos cargados: {', '.join(missing)}")
+        result = aggregate_daily(result, group_by)
+    if sort_by:
+        if sort_by not in result.columns:
+            raise ValueError(f"No se puede ordenar por '{sort_by}'")
+        result = result.sort_values(sort_by, ascending=ascending)
+    if top_k:
+        result = result.head(int(top_k))
+    return result.reset_index(drop=True)
+
+# --- PREPARACIÓN PARA VISUALIZAR ---
+# Altair serializa los datos en la especificación JSON: por encima de unos cientos de puntos la página se bloquea
+CHART_MAX_POINTS = 200
+TABLE_PAGE_SIZE = 50
+
+def series_label(df, key_cols):
+    # Etiqueta única por fila cuando hay varias dimensiones, construida por columnas
+    label = df[key_cols[0]].astype(str)
+    if len(key_cols) > 1:
+        label = label.str.cat([df[col].astype(str) for col in key_cols[1:]], sep=' · ')
+    return label.to_numpy()
+
+def chart_frame(df, key_cols, max_points=CHART_MAX_POINTS):
+    # Con la dimensión fecha se agrega por día en el servidor; si no, solo se envían las primeras filas
+    if 'date' in key_cols:
+        chart_df = aggregate_daily(df, ['date']).sort_values('date').tail(max_points)
+        return chart_df.rename(columns={'date': 'label'}).reset_index(drop=True), 'T'
+    chart_df = df.head(min(max_points, CHART_MAX_POINTS))
+    return chart_df[METRIC_COLUMNS].assign(label=series_label(chart_df, key_cols)), 'N'
+
+def table_page(df, page, page_size=TABLE_PAGE_SIZE):
+    # Página visible de la tabla (1-indexada), sin copiar ni formatear el resto del DataFrame
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size]
+
+# --- TENDENCIAS Y ANOMALÍAS ---
+TREND_WINDOW_DAYS = 7
+# La referencia de cada día son los 28 anteriores: con menos días la desviación estimada es muy ruidosa
+ANOMALY_BASELINE_DAYS = 28
+ANOMALY_Z_THRESHOLD = 3.5
+# Con pocas impresiones el CTR diario es demasiado ruidoso para marcarlo como anómalo
+ANOMALY_MIN_IMPRESSIONS = 20
+# Desviación mínima (en puntos de CTR) para que una serie casi constante no dispare el z-score
+ANOMALY_MIN_STD = 0.5
+TREND_MAX_SERIES = 10
+TREND_COLUMNS = [
+    'clicks', 'impressions', 'clicks_previous', 'clicks_current', 'clicks_delta',
+    'ctr_previous', 'ctr_current', 'ctr_delta', 'position_previous', 'position_current', 'position_delta',
+    'anomalies', 'last_anomaly', 'worst_z'
+]
+
+def _rolling_sum(matrix, window):
+    # Suma móvil por filas a partir de la suma acumulada
+    cumsum = np.cumsum(matrix, axis=1)
+    result = np.empty_like(cumsum)
+    result[:, :window] = cumsum[:, :window]
+    np.subtract(cumsum[:, window:], cumsum[:, :-window], out=result[:, window:])
+    return result
+
+def _ratio(numerator, denominator, scale=1.0):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator * scale, np.nan)
+
+def compute_trends(df, key_cols=('query',), window=TREND_WINDOW_DAYS, z_threshold=ANOMALY_Z_THRESHOLD, max_series=TREND_MAX_SERIES):
+    # Pasa las filas (clave, día) a matrices densas claves × días y calcula todas las series a la vez.
+    # Devuelve (resumen por clave, serie diaria de las claves más relevantes para los gráficos)
+    key_cols = [col for col in key_cols if col != 'date']
+    if df.empty or 'date' not in df.columns:
+        return pd.DataFrame(), pd.DataFrame()
+
+    if key_cols:
+        codes = df.groupby(key_cols, sort=False, observed=True).ngroup().to_numpy()
+        # ngroup con sort=False numera las claves en orden de aparición
+        first_rows = np.flatnonzero(~pd.Series(codes).duplicated().to_numpy())
+        keys = df[key_cols].iloc[first_rows].reset_index(drop=True)
+    else:
+        codes = np.zeros(len(df), dtype=np.int64)
+        keys = pd.DataFrame({'serie': ['Total']})
+        key_cols = ['serie']
+    start = df['date'].min()
+    days = ((df['date'] - start) // pd.Timedelta(days=1)).to_numpy()
+    valid_rows = codes >= 0
+    n_keys, n_days = len(keys), int(days.max()) + 1
+    flat = codes[valid_rows] * n_days + days[valid_rows]
+
+    def matrix(values):
+        weights = np.asarray(values, dtype=np.float64)[valid_rows]
+        return np.bincount(flat, weights=weights, minlength=n_keys * n_days).reshape(n_keys, n_days)
+
+    clicks = matrix(df['clicks'])
+    impressions = matrix(df['impressions'])
+    position_weight = matrix(df['position'].to_numpy(dtype=np.float64) * df['impressions'].to_numpy())
+
+    # CTR diario y móvil (en %)
+    ctr = _ratio(clicks, impressions, 100)
+    ctr_rolling = _ratio(_rolling_sum(clicks, window), _rolling_sum(impressions, window), 100)
+
+    # Anomalías: z-score del CTR del día frente a la media y desviación de los días anteriores
+    reliable = impressions >= ANOMALY_MIN_IMPRESSIONS
+    values = np.where(reliable, ctr, 0.0)
+    sums = [np.zeros_like(values) for _ in range(3)]
+    for total, series in zip(sums, (reliable.astype(np.float64), values, values ** 2)):
+        total[:, 1:] = _rolling_sum(series, ANOMALY_BASELINE_DAYS)[:, :-1]
+    count, sum_ctr, sum_sq = sums
+    mean = _ratio(sum_ctr, count)
+    std = np.sqrt(np.maximum(_ratio(sum_sq - count * mean ** 2, count - 1), 0))
+    with np.errstate(invalid='ignore'):
+        z = np.where(reliable & (count >= window), (ctr - mean) / np.maximum(std, ANOMALY_MIN_STD), np.nan)
+        abs_z = np.abs(z)
+        anomaly = abs_z >= z_threshold
+
+    # Período actual (segunda mitad del rango) frente al anterior (primera mitad)
+    half = max(n_days // 2, 1)
+    current = slice(n_days - half, n_days)
+    previous = slice(max(n_days - 2 * half, 0), n_days - half)
+    totals = {}
+    for name, period in (('previous', previous), ('current', current)):
+        period_clicks = clicks[:, period].sum(axis=1)
+        period_impressions = impressions[:, period].sum(axis=1)
+        totals[name] = (
+            period_clicks,
+            _ratio(period_clicks, period_impressions, 100),
+            _ratio(position_weight[:, period].sum(axis=1), period_impressions)
+        )
+
+    dates = pd.date_range(start, periods=n_days)
+    anomaly_count = anomaly.sum(axis=1)
+    last_anomaly = np.where(anomaly.any(axis=1), n_days - 1 - np.argmax(anomaly[:, ::-1], axis=1), -1)
+    abs_z[np.isnan(abs_z)] = -1
+    worst_day = np.argmax(abs_z, axis=1)
+    summary = keys.assign(
+        # Las sumas de todo el rango (y la serie 'Total' de todo el sitio) superan con facilidad el rango de int32
+        clicks=clicks.sum(axis=1).astype(np.int64),
+        impressions=impressions.sum(axis=1).astype(np.int64),
+        clicks_previous=totals['previous'][0].astype(np.int64),
+        clicks_current=totals['current'][0].astype(np.int64),
+        clicks_delta=(totals['current'][0] - totals['previous'][0]).astype(np.int64),
+        ctr_previous=np.round(totals['previous'][1], 2).astype(np.float32),
+        ctr_current=np.round(totals['current'][1], 2).astype(np.float32),
+        ctr_delta=np.round(totals['current'][1] - totals['previous'][1], 2).astype(np.float32),
+        position_previous=np.round(totals['previous'][2], 1).astype(np.float32),
+        position_current=np.round(totals['current'][2], 1).astype(np.float32),
+        position_delta=np.round(totals['current'][2] - totals['previous'][2], 1).astype(np.float32),
+        anomalies=anomaly_count.astype(np.int32),
+        last_anomaly=pd.Series(dates[np.maximum(last_anomaly, 0)]).where(last_anomaly >= 0),
+        worst_z=np.round(z[np.arange(n_keys), worst_day], 1).astype(np.float32)
+    )
+
+    # Para los gráficos: primero las series con anomalías y, dentro de ellas, las de más impresiones
+    order = np.lexsort((-summary['impressions'].to_numpy(), -np.minimum(anomaly_count, 1)))[:max_series]
+    daily = keys.iloc[np.repeat(order, n_days)].reset_index(drop=True).assign(
+        date=np.tile(dates, len(order)),
+        clicks=clicks[order].ravel().astype(np.int64),
+        impressions=impressions[order].ravel().astype(np.int64),
+        ctr=np.round(ctr[order].ravel(), 2).astype(np.float32),
+        ctr_rolling=np.round(ctr_rolling[order].ravel(), 2).astype(np.float32),
+        z=np.round(z[order].ravel(), 1).astype(np.float32),
+        anomaly=anomaly[order].ravel()
+    )
+    daily['label'] = series_label(daily, key_cols)
+    return summary.sort_values('impressions', ascending=False, ignore_index=True), daily
+
+# --- EXPORTACIÓN ---
+# Formato -> (extensión, tipo MIME)
+EXPORT_FORMATS = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file'),
+    'csv.gz': ('csv.gz', 'application/gzip'),
+}
+
+def serialize_dataframe(df, fmt='parquet'):
+    # Formatos columnares comprimidos; mucho más rápidos de generar que un CSV plano a gran escala
+    buffer = io.BytesIO()
+    if fmt == 'parquet':
+        df.to_parquet(buffer, index=False, compression='zstd')
+    elif fmt == 'arrow':
+        df.reset_index(drop=True).to_feather(buffer, compression='zstd')
+    elif fmt == 'csv.gz':
+        df.to_csv(buffer, index=False, compression={'method': 'gzip', 'compresslevel': 6})
+    else:
+        raise ValueError(f"Formato de exportación no soportado: {fmt}")
+    return buffer.getvalue()
@@ -0,0 +1,87 @@
+import json
+
+import pandas as pd
+import pytest
+
+from llm_agent import parse_intent, plan_from_intent
+
+SITE, START, END = 'https://example.com/', '2026-01-01', '2026-01-31'
+
+# --- INTÉRPRETE LOCAL DE INTENCIONES ---
+# (pregunta, argumentos esperados de la consulta, análisis local esperado)
+UNDERSTOOD = [
+    ("¿Cuáles son las 10 consultas con mayor CTR?", {}, {'sort_by': 'ctr', 'ascending': False, 'top_k': 10}),
+    ("top 5 páginas con más clics", {'dimensions': ['page']}, {'sort_by': 'clicks', 'ascending': False, 'top_k': 5}),
+    ("consultas por dispositivo", {'dimensions': ['query', 'device']}, {}),
+    ("consultas que contienen 'zapatos' con más impresiones", {'query_filter': 'zapatos'},
+     {'sort_by': 'impressions', 'ascending': False}),
+    ("¿Qué consultas tienen más de 1.000 clics?", {},
+     {'filters': [{'column': 'clicks', 'operator': '>', 'value': 1000.0}]}),
+    ("impresiones mayores a 10.000", {},
+     {'filters': [{'column': 'impressions', 'operator': '>', 'value': 10000.0}]}),
+    ("consultas con CTR menor a 2,5", {}, {'filters': [{'column': 'ctr', 'operator': '<', 'value': 2.5}]}),
+    ("CTR superior a 1.5", {}, {'filters': [{'column': 'ctr', 'operator': '>', 'value': 1.5}]}),
+    ("¿Cuáles son mis 10 mejores consultas por CTR?", {}, {'sort_by': 'ctr', 'ascending': False, 'top_k': 10}),
+    ("peores páginas por posición", {'dimensions': ['page']}, {'sort_by': 'position', 'ascending': False}),
+    ("¿Cuáles son las consultas con mejor posición?", {}, {'sort_by': 'position', 'ascending': True}),
+    ("¿Qué consultas tienen menos clics?", {}, {'sort_by': 'clicks', 'ascending': True}),
+    ("consultas con más de 50 clics en móvil", {'dimensions': ['query', 'device']},
+     {'filters': [{'column': 'clicks', 'operator': '>', 'value': 50.0},
+                  {'column': 'device', 'operator': '==', 'value': 'MOBILE'}]}),
+]
+
+AMBIGUOUS = [
+    "¿Cuántos clics tiene la marca nike?",
+    "¿Qué tal posicionan las consultas de zapatos?",
+    "consultas de python con más clics",
+    "Top 5 consultas en España",
+    "CTR de la página /blog/python",
+    "consultas de seo",
+    "consultas relacionadas con zapatos",
+    "¿Qué consultas mejoraron el mes pasado?",
+    "compara el CTR de enero y febrero",
+    "consultas con ctr entre 2 y 5",
+    "consultas con ctr de más del 5%",
+    "peores consultas",
+    "10 mejores consultas",
+    "consultas con clics en móvil y escritorio",
+]
+
+@pytest.mark.parametrize("question, fetch, analysis", UNDERSTOOD)
+def test_parse_intent_understood(question, fetch, analysis):
+    intent = parse_intent(question, SITE, START, END)
+    assert intent is not None
+    expected_fetch = dict({'site_url': SITE, 'start_date': START, 'end_date': END, 'query_filter': None}, **fetch)
+    assert intent['fetch'] == expected_fetch
+    assert intent['analysis'] == analysis
+
+@pytest.mark.parametrize("question", AMBIGUOUS)
+def test_parse_intent_falls_back_to_model(question):
+    assert parse_intent(question, SITE, START, END) is None
+
+def test_parse_intent_last_days():
+    intent = parse_intent("consultas con más clics de los últimos 30 días", SITE, START, END)
+    assert intent is not None
+    assert intent['fetch']['start_date'] != START
+
+# --- REUTILIZACIÓN DE LOS DATOS CARGADOS ---
+LOADED = {
+    'df': pd.DataFrame({'query': ['a'], 'clicks': [1], 'impressions': [10], 'ctr': [10.0], 'position': [1.0]}),
+    'site_url': SITE,
+    'start_date': START,
+    'end_date': END,
+    'query_filter': None,
+}
+
+@pytest.mark.parametrize("question, dimensions, expected", [
+    ("top 10 consultas", ['query'], 'analyze_loaded_data'),
+    ("top 10 consultas", None, 'analyze_loaded_data'),
+    ("top 10 consultas", ['query', 'date'], 'get_search_console_ctr'),
+    ("top 10 consultas", ['page'], 'get_search_console_ctr'),
+    ("consultas por país", ['query'], 'get_search_console_ctr'),
+])
+def test_plan_from_intent_matches_dimensions(question, dimensions, expected):
+    plan = plan_from_intent(parse_intent(question, SITE, START, END), LOADED, dimensions)
+    assert plan['name'] == expected
+    if expected == 'analyze_loaded_data':
+        assert json.loads(plan['arguments']) == {'top_k': 10}
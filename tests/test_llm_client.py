@@ -0,0 +1,55 @@
+import concurrent.futures
+import time
+
+import openai
+import pytest
+
+import llm_client
+from benchmarks.stubs import FakeChatServer
+from llm_client import LLMClient
+
+MESSAGES = [{'role': 'user', 'content': 'hola'}]
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_client, 'LLM_RETRY_MAX_SECONDS', 0.01)
+
+# --- TIMEOUTS ---
+def test_timeout_retries_then_reports_seconds():
+    with FakeChatServer(latency=0.5) as chat:
+        client = LLMClient('sk-test', base_url=chat.base_url, timeout=0.1, max_retries=1)
+        with pytest.raises(TimeoutError, match=r"0\.1s"):
+            client.complete(MESSAGES)
+        assert chat.requests == 2
+
+def test_stream_idle_timeout():
+    with FakeChatServer(latency=0.5) as chat:
+        client = LLMClient('sk-test', base_url=chat.base_url, max_retries=0)
+        with pytest.raises(TimeoutError, match=r"0\.2s"):
+            ''.join(client.stream(MESSAGES, idle_timeout=0.2))
+
+# --- REINTENTOS ---
+def test_transient_errors_are_retried():
+    with FakeChatServer(fail_first=2) as chat:
+        client = LLMClient('sk-test', base_url=chat.base_url, max_retries=2)
+        assert client.complete(MESSAGES).content == 'ok'
+        assert chat.requests == 3
+
+def test_retries_are_bounded():
+    with FakeChatServer(fail_first=5) as chat:
+        client = LLMClient('sk-test', base_url=chat.base_url, max_retries=1)
+        with pytest.raises(openai.InternalServerError):
+            client.complete(MESSAGES)
+        assert chat.requests == 2
+
+# --- CANCELACIÓN ---
+def test_cancel_group_stops_pending_stream():
+    with FakeChatServer(latency=2.0) as chat:
+        client = LLMClient('sk-test', base_url=chat.base_url)
+        chunks = client.stream(MESSAGES, group='sesion')
+        assert client.cancel('sesion') == 1
+        started = time.perf_counter()
+        with pytest.raises(concurrent.futures.CancelledError):
+            next(chunks)
+        assert time.perf_counter() - started < 1.0
+        assert client.cancel('sesion') == 0
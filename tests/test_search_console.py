@@ -0,0 +1,130 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+import search_console
+from benchmarks.stubs import SearchConsoleHttpMock
+from search_console import (
+    METRIC_COLUMNS,
+    ResultStore,
+    SearchConsoleClient,
+    TokenBucket,
+    compute_trends,
+    fetch_search_console,
+    get_result_store,
+    run_local_analysis,
+)
+
+# --- MOTOR DE ANÁLISIS LOCAL ---
+LOADED = pd.DataFrame({
+    'query': ['a', 'b', 'c'],
+    'device': ['MOBILE', 'DESKTOP', 'MOBILE'],
+    'clicks': [1, 2, 3],
+    'impressions': [10, 20, 30],
+    'ctr': [10.0, 10.0, 10.0],
+    'position': [1.0, 2.0, 3.0],
+})
+
+def test_group_by_with_empty_filter_result():
+    result = run_local_analysis(
+        LOADED,
+        filters=[{'column': 'clicks', 'operator': '>', 'value': 100}],
+        group_by=['device'],
+        sort_by='clicks',
+        top_k=5
+    )
+    assert result.empty
+    assert list(result.columns) == ['device'] + METRIC_COLUMNS
+
+def test_group_by_rejects_metrics():
+    with pytest.raises(ValueError):
+        run_local_analysis(LOADED, group_by=['clicks'])
+
+# --- TENDENCIAS Y ANOMALÍAS ---
+def test_trend_totals_do_not_overflow():
+    # 60 días con 100 millones de impresiones suman más de lo que cabe en int32
+    days = pd.date_range('2026-01-01', periods=60)
+    df = pd.DataFrame({
+        'date': days,
+        'clicks': [80_000_000] * len(days),
+        'impressions': [100_000_000] * len(days),
+        'ctr': [80.0] * len(days),
+        'position': [3.0] * len(days),
+    })
+    summary, _ = compute_trends(df, [])
+    assert summary.loc[0, 'impressions'] == 6_000_000_000
+    assert summary.loc[0, 'clicks_current'] == 30 * 80_000_000
+    assert summary.loc[0, 'clicks_delta'] == 0
+
+# --- ALMACÉN COMPARTIDO ENTRE SESIONES ---
+def frame(rows=10):
+    return pd.DataFrame({'query': [f"q{i}" for i in range(rows)], 'clicks': range(rows)})
+
+def test_concurrent_requests_are_coalesced():
+    store = ResultStore()
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return frame()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(store.get_or_load, 'k', loader) for _ in range(8)]
+        while store.usage()['coalesced'] < 7:
+            time.sleep(0.01)
+        release.set()
+        sources = sorted(future.result()[1] for future in futures)
+    assert len(calls) == 1
+    assert sources == ['coalesced'] * 7 + ['loaded']
+    assert store.get_or_load('k', loader)[1] == 'memory'
+
+def test_errors_reach_waiters_and_are_not_stored():
+    store = ResultStore()
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise RuntimeError("cuota agotada")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(store.get_or_load, 'k', failing)
+        while store.usage()['misses'] < 1:
+            time.sleep(0.01)
+        waiter = executor.submit(store.get_or_load, 'k', failing)
+        while store.usage()['coalesced'] < 1:
+            time.sleep(0.01)
+        release.set()
+        for future in (leader, waiter):
+            with pytest.raises(RuntimeError):
+                future.result()
+    assert store.usage()['entries'] == 0
+    assert store.get_or_load('k', frame)[1] == 'loaded'
+
+def test_least_recently_used_results_are_evicted():
+    size = int(frame().memory_usage(index=True, deep=True).sum())
+    store = ResultStore(max_bytes=2 * size)
+    store.get_or_load('a', frame)
+    store.get_or_load('b', frame)
+    store.get_or_load('a', frame)
+    store.get_or_load('c', frame)
+    assert store.usage()['entries'] == 2
+    assert store.get_or_load('a', frame)[1] == 'memory'
+    assert store.get_or_load('b', frame)[1] == 'loaded'
+
+def test_expired_results_are_reloaded():
+    store = ResultStore()
+    store.get_or_load('k', frame, expires_at=time.time() - 1)
+    assert store.get_or_load('k', frame)[1] == 'loaded'
+
+def test_batch_fetch_bypasses_the_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(search_console, 'CACHE_DB_PATH', str(tmp_path / 'cache.sqlite'))
+    client = SearchConsoleClient(None, limiter=TokenBucket(1e9, 1e9), http=SearchConsoleHttpMock(100))
+    get_result_store().clear()
+    df = fetch_search_console(client, 'https://example.com/', '2026-01-01', '2026-01-31', shared=False)
+    assert len(df) == 100
+    assert get_result_store().usage()['entries'] == 0
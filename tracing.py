@@ -0,0 +1,174 @@
+# Trazas de rendimiento por petición: tiempo, filas, bytes, cuota de la API y tokens de cada etapa.
+# No depende de Streamlit. Exporta a JSON lines (TRACE_JSONL_PATH) y a OpenTelemetry si está instalado.
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+
+# OpenTelemetry es opcional: sin un proveedor configurado, la API no exporta nada
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+TRACE_JSONL_PATH = os.environ.get("TRACE_JSONL_PATH") or None
+# Trazas recientes que se conservan en memoria para el panel y los percentiles
+TRACE_HISTORY = 500
+COUNTERS = ['rows', 'bytes', 'quota_units', 'retries', 'prompt_tokens', 'completion_tokens']
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.duration = None
+        self._started_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, **counters):
+        # Los contadores pueden sumarse desde varios hilos de la misma etapa
+        with self._lock:
+            for name, value in counters.items():
+                self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started_at
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round((self.duration or 0) * 1000, 1),
+            'attributes': self.attributes,
+        }
+
+_current_spans = contextvars.ContextVar('current_spans', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_history = deque(maxlen=TRACE_HISTORY)
+_history_lock = threading.Lock()
+
+@contextmanager
+def trace(name, **attributes):
+    # Raíz de una petición del usuario; al cerrarse se guarda en el historial y se exporta
+    root = Span(name, uuid.uuid4().hex, attributes=attributes)
+    spans = [root]
+    tokens = _current_spans.set(spans), _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.set(error=type(e).__name__)
+        raise
+    finally:
+        root.end()
+        _current_span.reset(tokens[1])
+        _current_spans.reset(tokens[0])
+        record_trace(spans)
+
+@contextmanager
+def span(name, **attributes):
+    # Etapa dentro de la traza activa; fuera de una traza se mide igual pero no se guarda
+    spans, parent = _current_spans.get(), _current_span.get()
+    current = Span(name, parent.trace_id if parent else None, parent.span_id if parent else None, attributes)
+    if spans is not None:
+        spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+
+def add(**counters):
+    # Suma contadores a la etapa en curso, si la hay
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counters)
+
+def annotate(**attributes):
+    # Fija atributos de la etapa en curso, si la hay
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+def in_current_context(fn):
+    # Para los pools de hilos: fn se ejecuta con la traza del hilo que la envía
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+# --- EXPORTACIÓN ---
+_jsonl_lock = threading.Lock()
+
+def record_trace(spans):
+    records = [span.to_dict() for span in spans]
+    with _history_lock:
+        _history.append(records)
+    if TRACE_JSONL_PATH:
+        with _jsonl_lock, open(TRACE_JSONL_PATH, 'a', encoding='utf-8') as f:
+            f.write(traces_to_jsonl([records]))
+    if otel_trace is not None:
+        export_otel(spans)
+
+def export_otel(spans):
+    # Reproduce las etapas ya medidas como spans de OpenTelemetry con sus tiempos reales
+    tracer = otel_trace.get_tracer("search_console_agent")
+    exported = {}
+    for span in spans:
+        parent = exported.get(span.parent_id)
+        attributes = {key: value for key, value in span.attributes.items() if isinstance(value, (str, bool, int, float))}
+        exported[span.span_id] = tracer.start_span(
+            span.name,
+            context=otel_trace.set_span_in_context(parent) if parent is not None else None,
+            start_time=int(span.start * 1e9),
+            attributes=attributes
+        )
+    for span in spans:
+        exported[span.span_id].end(end_time=int((span.start + (span.duration or 0)) * 1e9))
+
+def traces_to_jsonl(traces):
+    return ''.join(json.dumps(record, default=str, ensure_ascii=False) + '\n' for records in traces for record in records)
+
+# --- CONSULTA DEL HISTORIAL ---
+def recent_traces(limit=None):
+    with _history_lock:
+        traces = list(_history)
+    return traces[-limit:] if limit else traces
+
+def spans_frame(records):
+    # Una fila por etapa con su duración y contadores
+    rows = [
+        {'stage': record['name'], 'ms': record['duration_ms'], **{key: record['attributes'].get(key) for key in COUNTERS}}
+        for record in records
+    ]
+    return pd.DataFrame(rows, columns=['stage', 'ms'] + COUNTERS).dropna(axis=1, how='all')
+
+def stage_percentiles(limit=None):
+    # p50/p95 móviles por etapa sobre las trazas recientes
+    records = [record for records in recent_traces(limit) for record in records]
+    if not records:
+        return pd.DataFrame()
+    durations = pd.DataFrame({'stage': [r['name'] for r in records], 'ms': [r['duration_ms'] for r in records]})
+    grouped = durations.groupby('stage')['ms']
+    return pd.DataFrame({
+        'n': grouped.size(),
+        'p50_ms': grouped.quantile(0.5).round(1),
+        'p95_ms': grouped.quantile(0.95).round(1),
+    }).sort_values('p95_ms', ascending=False).reset_index()